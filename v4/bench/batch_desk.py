@@ -0,0 +1,128 @@
+"""Выдача и возврат нескольких книг за раз: по одной против пакетных эндпоинтов gateway.
+
+Сервисы и gateway поднимаются локально, как в loadtest.py. Операция библиотекаря -
+выдать пользователю --items книг и принять их обратно:
+
+  * single - --items раз POST /api/v1/reservations и столько же возвратов;
+  * batch - один POST /api/v1/reservations/batch и один POST /api/v1/reservations/return.
+
+--latency-ms добавляет задержку к каждому запросу клиента к gateway.
+
+    python batch_desk.py --operations 200 --items 5
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+import requests
+
+from loadtest import BENCH_DIR, RESULTS_DIR, git_revision, percentile, seed, start_local
+
+
+class Client:
+    def __init__(self, base, latency):
+        self.session = requests.Session()
+        self.base = base
+        self.latency = latency
+        self.calls = 0
+
+    def post(self, path, user, body):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        resp = self.session.post(f"{self.base}{path}", json=body, headers={"X-User-Name": user}, timeout=10)
+        resp.raise_for_status()
+        return resp.json() if resp.content else None
+
+
+def single(client, user, items):
+    reservations = [client.post("/api/v1/reservations", user, item) for item in items]
+    for reservation in reservations:
+        client.post(f"/api/v1/reservations/{reservation['reservationUid']}/return", user,
+                    {"condition": "EXCELLENT", "date": "2029-12-31"})
+
+
+def batch(client, user, items):
+    reservations = client.post("/api/v1/reservations/batch", user, {"items": items})["items"]
+    client.post("/api/v1/reservations/return", user,
+                {"items": [{"reservationUid": r["reservationUid"], "condition": "EXCELLENT", "date": "2029-12-31"}
+                           for r in reservations]})
+
+
+FLOWS = {"single": single, "batch": batch}
+
+
+def run(flow, base, data, args, rnd):
+    client = Client(base, args.latency_ms / 1000)
+    latencies = []
+    for i in range(args.warmup + args.operations):
+        user = rnd.choice(data["users"])
+        items = [
+            {"libraryUid": library_uid, "bookUid": book_uid, "tillDate": "2030-01-01"}
+            for library_uid, book_uid in rnd.sample(data["stock"], args.items)
+        ]
+        started = time.perf_counter()
+        FLOWS[flow](client, user, items)
+        elapsed = time.perf_counter() - started
+        if i >= args.warmup:
+            latencies.append(elapsed)
+
+    latencies.sort()
+    return {
+        "count": len(latencies),
+        "calls": client.calls // (args.warmup + args.operations),
+        "books_per_s": round(args.items * len(latencies) / sum(latencies), 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", default=os.path.join(BENCH_DIR, ".data"))
+    parser.add_argument("--gateway-port", type=int, default=18080)
+    parser.add_argument("--operations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--items", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--libraries", type=int, default=20)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--reservations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--label", default="batch-desk")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    data = seed(start_local(args.workdir, args.gateway_port), args)
+    base = f"http://127.0.0.1:{args.gateway_port}"
+
+    report = {}
+    for flow in FLOWS:
+        report[flow] = run(flow, base, data, args, random.Random(args.seed))
+
+    header = f"{'flow':<10}{'calls':>7}{'books/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+    print(f"books per operation: {args.items}, latency per call: {args.latency_ms} ms")
+    print(header)
+    print("-" * len(header))
+    for flow, row in report.items():
+        print(f"{flow:<10}{row['calls']:>7}{row['books_per_s']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}")
+    print(f"throughput x{report['batch']['books_per_s'] / report['single']['books_per_s']:.1f}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.label}.json")
+    with open(path, "w") as f:
+        json.dump({
+            "label": args.label,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "config": {key: value for key, value in vars(args).items() if key != "workdir"},
+            "flows": report,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
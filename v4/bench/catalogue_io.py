@@ -0,0 +1,85 @@
+"""Скорость импорта и экспорта каталога library_service.
+
+Генерирует каталог на --books книг (NDJSON, тело запроса отправляется потоком, целиком
+в памяти не собирается), загружает его через POST /catalogue/import и выгружает
+обратно через GET /catalogue/export.
+
+    python catalogue_io.py --books 1000000
+    python catalogue_io.py --library http://localhost:8060 --books 1000000
+"""
+import argparse
+import json
+import os
+import time
+from uuid import uuid4
+
+import requests
+
+from loadtest import BENCH_DIR, CITIES, SERVICES, load_service, serve
+
+
+def catalogue(libraries, books):
+    library_uids = [str(uuid4()) for _ in range(libraries)]
+    for i, library_uid in enumerate(library_uids):
+        yield {"libraryUid": library_uid, "libraryName": f"Bench library {i}",
+               "city": CITIES[i % len(CITIES)], "address": f"ул. Тестовая, д.{i}"}
+    for i in range(books):
+        yield {"libraryUid": library_uids[i % libraries], "bookUid": str(uuid4()),
+               "name": f"Bench book {i}", "author": f"Author {i % 500}", "genre": f"Genre {i % 20}",
+               "availableCount": i % 6}
+
+
+def ndjson_chunks(records, chunk_size=1000):
+    chunk = []
+    for record in records:
+        chunk.append(json.dumps(record, ensure_ascii=False))
+        if len(chunk) >= chunk_size:
+            yield ("\n".join(chunk) + "\n").encode()
+            chunk = []
+    if chunk:
+        yield ("\n".join(chunk) + "\n").encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--library", help="URL запущенного library_service; без него сервис стартует локально")
+    parser.add_argument("--workdir", default=os.path.join(BENCH_DIR, ".data"))
+    parser.add_argument("--libraries", type=int, default=50)
+    parser.add_argument("--books", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.library:
+        base = args.library.rstrip("/")
+    else:
+        os.makedirs(args.workdir, exist_ok=True)
+        path = os.path.join(args.workdir, "catalogue.db")
+        if os.path.exists(path):
+            os.remove(path)
+        database, port = SERVICES["library"]
+        serve(load_service("library", f"sqlite:///{path}").app, port)
+        base = f"http://127.0.0.1:{port}"
+
+    started = time.perf_counter()
+    resp = requests.post(
+        f"{base}/catalogue/import", data=ndjson_chunks(catalogue(args.libraries, args.books)),
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    resp.raise_for_status()
+    elapsed = time.perf_counter() - started
+    result = resp.json()
+    print(f"import: {result['rows']} rows ({result['rejected']} rejected) in {elapsed:.1f}s, "
+          f"{result['rows'] / elapsed:,.0f} rows/s")
+
+    started = time.perf_counter()
+    rows = size = 0
+    with requests.get(f"{base}/catalogue/export", stream=True) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=1 << 16):
+            rows += chunk.count(b"\n")
+            size += len(chunk)
+    elapsed = time.perf_counter() - started
+    print(f"export: {rows} rows, {size / 1e6:.1f} MB in {elapsed:.1f}s, {rows / elapsed:,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Задержка создания брони: прежняя цепочка вызовов против составных эндпоинтов.
+
+Сервисы поднимаются локально, как в loadtest.py, и вызываются напрямую - так, как их
+вызывает gateway при POST /api/v1/reservations:
+
+  * sequential - прежний порядок: число взятых книг, рейтинг, книга, библиотека
+    (параллельно), затем списание со склада и создание брони - 6 вызовов, 3 шага;
+  * composite - рейтинг и POST /reserve в library (списание и метаданные) параллельно,
+    затем бронь с maxRented - 3 вызова, 2 шага.
+
+На localhost сетевой вызов почти бесплатный; --latency-ms добавляет к каждому вызову
+задержку сети между контейнерами, чтобы разница в числе шагов была видна.
+
+    python reserve_hops.py --iterations 500 --latency-ms 2
+"""
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import requests
+
+from loadtest import BENCH_DIR, RESULTS_DIR, SERVICES, git_revision, percentile, seed, start_local
+
+LIBRARY_URL = f"http://127.0.0.1:{SERVICES['library'][1]}"
+RATING_URL = f"http://127.0.0.1:{SERVICES['rating'][1]}"
+RESERVATION_URL = f"http://127.0.0.1:{SERVICES['reservation'][1]}"
+
+
+class Client:
+    def __init__(self, latency):
+        self.session = requests.Session()
+        self.latency = latency
+        self.calls = 0
+
+    def call(self, method, url, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        resp = self.session.request(method, url, timeout=5, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+
+def sequential(client, pool, user, library_uid, book_uid, till_date):
+    headers = {"X-User-Name": user}
+    rented = pool.submit(client.call, "GET", f"{RESERVATION_URL}/reservations/{user}/count")
+    rating = pool.submit(client.call, "GET", f"{RATING_URL}/rating", headers=headers)
+    books = pool.submit(client.call, "GET", f"{LIBRARY_URL}/books/batch", params={"bookUid": book_uid})
+    libraries = pool.submit(client.call, "GET", f"{LIBRARY_URL}/libraries/batch", params={"libraryUid": library_uid})
+    if rented.result().json()["rentedCount"] >= rating.result().json()["stars"]:
+        raise RuntimeError("limit reached")
+    books.result(), libraries.result()
+
+    operation_id = str(uuid4())
+    client.call("PATCH", f"{LIBRARY_URL}/libraries/{library_uid}/books/{book_uid}/decrement",
+                headers={"X-Operation-Id": operation_id})
+    payload = {"bookUid": book_uid, "libraryUid": library_uid, "tillDate": till_date}
+    return client.call("POST", f"{RESERVATION_URL}/reservations", json=payload,
+                       headers={**headers, "Idempotency-Key": operation_id}).json()
+
+
+def composite(client, pool, user, library_uid, book_uid, till_date):
+    headers = {"X-User-Name": user}
+    operation_id = str(uuid4())
+    rating = pool.submit(client.call, "GET", f"{RATING_URL}/rating", headers=headers)
+    stock = pool.submit(client.call, "POST", f"{LIBRARY_URL}/libraries/{library_uid}/books/{book_uid}/reserve",
+                        headers={"X-Operation-Id": operation_id})
+    stars = rating.result().json()["stars"]
+    stock.result()
+
+    payload = {"bookUid": book_uid, "libraryUid": library_uid, "tillDate": till_date, "maxRented": stars}
+    return client.call("POST", f"{RESERVATION_URL}/reservations", json=payload,
+                       headers={**headers, "Idempotency-Key": operation_id}).json()
+
+
+FLOWS = {"sequential": sequential, "composite": composite}
+
+
+def run(flow, data, args, rnd):
+    client = Client(args.latency_ms / 1000)
+    cleanup = requests.Session()
+    latencies = []
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for i in range(args.warmup + args.iterations):
+            user = rnd.choice(data["users"])
+            library_uid, book_uid = rnd.choice(data["stock"])
+            started = time.perf_counter()
+            reservation = FLOWS[flow](client, pool, user, library_uid, book_uid, "2030-01-01")
+            elapsed = time.perf_counter() - started
+            if i >= args.warmup:
+                latencies.append(elapsed)
+
+            # Возврат вне замера: остаток и лимит пользователя не расходуются
+            cleanup.post(f"{RESERVATION_URL}/reservations/{reservation['reservationUid']}/return", timeout=5)
+            cleanup.patch(f"{LIBRARY_URL}/libraries/{library_uid}/books/{book_uid}/increment", timeout=5)
+
+    latencies.sort()
+    return {
+        "count": len(latencies),
+        "calls": client.calls // (args.warmup + args.iterations),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", default=os.path.join(BENCH_DIR, ".data"))
+    parser.add_argument("--gateway-port", type=int, default=18080)
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--libraries", type=int, default=20)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--reservations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--label", default="reserve-hops")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    data = seed(start_local(args.workdir, args.gateway_port), args)
+
+    report = {}
+    for flow in FLOWS:
+        report[flow] = run(flow, data, args, random.Random(args.seed))
+
+    header = f"{'flow':<14}{'calls':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(f"latency per call: {args.latency_ms} ms")
+    print(header)
+    print("-" * len(header))
+    for flow, row in report.items():
+        print(f"{flow:<14}{row['calls']:>7}{row['mean_ms']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    old, new = report["sequential"], report["composite"]
+    print(f"p50 {(new['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100:+.1f}%, "
+          f"p95 {(new['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100:+.1f}%")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.label}.json")
+    with open(path, "w") as f:
+        json.dump({
+            "label": args.label,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "config": {key: value for key, value in vars(args).items() if key != "workdir"},
+            "flows": report,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
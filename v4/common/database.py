@@ -0,0 +1,56 @@
+import os
+
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool
+
+# Настройки пула соединений SQLAlchemy, одинаковые для library, rating и reservation.
+# Значения задаются переменными окружения отдельно для каждого сервиса.
+#
+# DB_POOLER=external - перед Postgres стоит внешний пулер (PgBouncer в режиме transaction):
+# свой пул отключается (NullPool), параметры сессии при подключении не передаются -
+# пулер их не поддерживает, statement_timeout выставляется на каждую транзакцию через SET LOCAL.
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 3))
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", 5000))
+DB_POOLER = os.environ.get("DB_POOLER", "").lower()
+
+
+def engine_options(database_url):
+    # -> SQLALCHEMY_ENGINE_OPTIONS
+    postgres = database_url.startswith("postgresql")
+    if DB_POOLER == "external":
+        options = {"poolclass": NullPool}
+    else:
+        options = {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            # Проверка соединения перед выдачей: после рестарта Postgres мёртвые
+            # соединения пула переоткрываются, а не падают на первом запросе
+            "pool_pre_ping": DB_POOL_PRE_PING,
+        }
+
+    if postgres:
+        connect_args = {"connect_timeout": DB_CONNECT_TIMEOUT}
+        if DB_STATEMENT_TIMEOUT and DB_POOLER != "external":
+            connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT}"
+        options["connect_args"] = connect_args
+    return options
+
+
+def init_engine(app, db):
+    # В режиме внешнего пулера statement_timeout нельзя задать на сессию
+    with app.app_context():
+        engine = db.engine
+    if DB_POOLER != "external" or not DB_STATEMENT_TIMEOUT or engine.dialect.name != "postgresql":
+        return
+
+    @event.listens_for(engine, "begin")
+    def set_statement_timeout(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT}")
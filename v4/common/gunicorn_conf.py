@@ -0,0 +1,51 @@
+import multiprocessing
+import os
+import sys
+
+# Настройки production-запуска для всех сервисов:
+#     gunicorn -c python:common.gunicorn_conf app:app
+# Всё настраивается переменными окружения, значения по умолчанию рассчитаны на контейнер.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# gthread для Flask-приложений; для асинхронного gateway - aiohttp.GunicornWebWorker
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 20))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+# Максимальная длина строки запроса (по умолчанию у gunicorn 4094, предел - 8190):
+# пакетные запросы gateway к library_service передают до LOOKUP_CHUNK_SIZE UID в query string
+limit_request_line = int(os.environ.get("GUNICORN_LIMIT_REQUEST_LINE", 8190))
+
+# preload: приложение (и миграции) загружается один раз в master-процессе,
+# worker'ы стартуют fork'ом без повторного импорта
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 0))
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    # При preload пул соединений SQLAlchemy создан в master - сокеты нельзя делить между процессами
+    app_module = sys.modules.get("app")
+    db = getattr(app_module, "db", None)
+    if db is not None:
+        with app_module.app.app_context():
+            db.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # Фоновые потоки (очередь рейтинга в gateway) запускаются в каждом worker'е.
+    # Асинхронный gateway запускает свои фоновые задачи сам, на event loop
+    if worker_class != "gthread":
+        return
+    app_module = sys.modules.get("app")
+    start = getattr(app_module, "start_background_workers", None)
+    if start is not None:
+        start()
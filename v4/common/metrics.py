@@ -0,0 +1,272 @@
+import atexit
+import json
+import os
+import time
+from bisect import bisect_left
+from threading import Lock, Thread
+
+# Метрики в текстовом формате Prometheus: GET /manage/metrics на каждом сервисе.
+# Счётчики копятся в памяти процесса под одной короткой блокировкой на запрос.
+# Под gunicorn у каждого воркера свои счётчики; если задан METRICS_DIR, воркеры раз в
+# METRICS_FLUSH_INTERVAL секунд сбрасывают туда снимок, и /manage/metrics любого
+# воркера отдаёт сумму по всем живым процессам.
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricFamily:
+    # merge - как складывать значения разных процессов: счётчики и гистограммы
+    # всегда суммируются, для gauge можно выбрать "sum" или "max"
+    def __init__(self, name, kind, help_text, merge="sum"):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.merge = merge
+        self.samples = {}
+
+    def add(self, value, suffix="", **labels):
+        self.samples[(self.name + suffix, tuple(sorted(labels.items())))] = value
+        return self
+
+    def histogram(self, bounds, cumulative, total, **labels):
+        # cumulative - накопленные счётчики по границам bounds, последний элемент - +Inf
+        for bound, count in zip(list(bounds) + ["+Inf"], cumulative):
+            self.add(count, "_bucket", le=str(bound), **labels)
+        self.add(cumulative[-1], "_count", **labels)
+        self.add(total, "_sum", **labels)
+        return self
+
+    def combine(self, other):
+        for key, value in other.samples.items():
+            if key not in self.samples:
+                self.samples[key] = value
+            elif self.kind == "gauge" and self.merge == "max":
+                self.samples[key] = max(self.samples[key], value)
+            else:
+                self.samples[key] += value
+
+    def to_dict(self):
+        return {
+            "name": self.name, "kind": self.kind, "help": self.help, "merge": self.merge,
+            "samples": [[name, list(labels), value] for (name, labels), value in self.samples.items()]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        family = cls(data["name"], data["kind"], data["help"], data["merge"])
+        for name, labels, value in data["samples"]:
+            family.samples[(name, tuple(tuple(label) for label in labels))] = value
+        return family
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for (name, labels), value in sorted(self.samples.items(), key=sample_order):
+            if labels:
+                # le у бакетов гистограммы - последней меткой, как принято в Prometheus
+                labels = sorted(labels, key=lambda label: label[0] == "le")
+                rendered = ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+                lines.append(f"{name}{{{rendered}}} {format_value(value)}")
+            else:
+                lines.append(f"{name} {format_value(value)}")
+        return lines
+
+
+def sample_order(item):
+    # Бакеты гистограммы - по возрастанию границы, а не по строке
+    (name, labels), _ = item
+    rest = tuple((key, value) for key, value in labels if key != "le")
+    le = dict(labels).get("le")
+    return name, rest, float(le) if le is not None else 0.0
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+class RequestMetrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.requests = {}
+        self.latency = {}
+
+    def observe(self, method, route, status, elapsed):
+        index = bisect_left(self.buckets, elapsed)
+        with self.lock:
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((method, route))
+            if histogram is None:
+                histogram = self.latency[(method, route)] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += elapsed
+
+    def collect(self):
+        with self.lock:
+            requests = dict(self.requests)
+            latency = {key: list(value) for key, value in self.latency.items()}
+
+        total = MetricFamily("http_requests_total", "counter", "Обработанные запросы по маршруту и статусу")
+        for (method, route, status), count in requests.items():
+            total.add(count, method=method, route=route, status=str(status))
+
+        duration = MetricFamily("http_request_duration_seconds", "histogram", "Время обработки запроса")
+        for (method, route), histogram in latency.items():
+            cumulative, running = [], 0
+            for count in histogram[:-1]:
+                running += count
+                cumulative.append(running)
+            duration.histogram(self.buckets, cumulative, histogram[-1], method=method, route=route)
+        return [total, duration]
+
+
+class Registry:
+    def __init__(self, service):
+        self.service = service
+        self.collectors = []
+        self.flush_pid = None
+        self.lock = Lock()
+
+    def register(self, collector):
+        # collector() -> список MetricFamily
+        self.collectors.append(collector)
+        return collector
+
+    def collect(self):
+        families = {}
+        for collector in self.collectors:
+            for family in collector():
+                if family.name in families:
+                    families[family.name].combine(family)
+                else:
+                    families[family.name] = family
+        return families
+
+    def render(self):
+        families = self.collect()
+        if METRICS_DIR:
+            for family in self._other_processes():
+                if family.name in families:
+                    families[family.name].combine(family)
+                else:
+                    families[family.name] = family
+
+        lines = []
+        for name in sorted(families):
+            lines.extend(families[name].render())
+        return "\n".join(lines) + "\n"
+
+    # -------------------- Снимки для нескольких процессов --------------------
+    def _snapshot_path(self, pid):
+        return os.path.join(METRICS_DIR, f"{self.service}-{pid}.json")
+
+    def _other_processes(self):
+        prefix = f"{self.service}-"
+        own = os.path.basename(self._snapshot_path(os.getpid()))
+        stale_before = time.time() - METRICS_FLUSH_INTERVAL * 3
+        families = []
+        try:
+            filenames = os.listdir(METRICS_DIR)
+        except OSError:
+            return families
+        for filename in filenames:
+            if not filename.startswith(prefix) or not filename.endswith(".json") or filename == own:
+                continue
+            path = os.path.join(METRICS_DIR, filename)
+            try:
+                if os.path.getmtime(path) < stale_before:
+                    # процесс завершился или завис - его счётчики больше не учитываем
+                    continue
+                with open(path) as f:
+                    families.extend(MetricFamily.from_dict(data) for data in json.load(f))
+            except (OSError, ValueError):
+                continue
+        return families
+
+    def flush(self):
+        path = self._snapshot_path(os.getpid())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([family.to_dict() for family in self.collect().values()], f)
+        os.replace(tmp_path, path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def start_flusher(self):
+        # Как и обработчик outbox в gateway, поток запускается в каждом процессе после fork
+        if not METRICS_DIR:
+            return
+        with self.lock:
+            if self.flush_pid == os.getpid():
+                return
+            self.flush_pid = os.getpid()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        atexit.register(self._remove_snapshot, os.getpid())
+        Thread(target=self._flush_loop, daemon=True).start()
+
+    def _remove_snapshot(self, pid):
+        try:
+            os.remove(self._snapshot_path(pid))
+        except OSError:
+            pass
+
+
+def pool_collector(engine):
+    def collect():
+        pool = engine.pool
+        families = [MetricFamily("db_pool_info", "gauge", "Тип пула соединений").add(1, pool=type(pool).__name__)]
+        for name, method, help_text in (
+            ("db_pool_size", "size", "Размер пула соединений"),
+            ("db_pool_checked_out", "checkedout", "Соединения, выданные запросам"),
+            ("db_pool_checked_in", "checkedin", "Свободные соединения в пуле"),
+            ("db_pool_overflow", "overflow", "Соединения сверх размера пула (меньше нуля - пул ещё не заполнен)"),
+        ):
+            if callable(getattr(pool, method, None)):
+                families.append(MetricFamily(name, "gauge", help_text).add(getattr(pool, method)()))
+        return families
+    return collect
+
+
+def init_flask(app, service, db=None):
+    from flask import Response, g, request
+
+    registry = Registry(service)
+    requests = RequestMetrics()
+    registry.register(requests.collect)
+    if db is not None:
+        with app.app_context():
+            registry.register(pool_collector(db.engine))
+
+    @app.before_request
+    def start_timer():
+        registry.start_flusher()
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get("metrics_started")
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            requests.observe(request.method, route, response.status_code, time.perf_counter() - started)
+        return response
+
+    @app.route("/manage/metrics", methods=["GET"])
+    def prometheus_metrics():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+    return registry
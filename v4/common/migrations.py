@@ -0,0 +1,51 @@
+import time
+
+from sqlalchemy import text
+
+# Общий раннер версионных миграций для library, rating и reservation.
+# Каждая миграция - (версия, описание, функция(connection)). Применённые версии
+# хранятся в таблице schema_version, поэтому каждая миграция выполняется ровно один раз.
+
+MIGRATION_LOCK_ID = 7234019
+MIGRATION_LOCK_TIMEOUT = 30
+
+
+def run_migrations(engine, migrations, lock_timeout=MIGRATION_LOCK_TIMEOUT):
+    started = time.monotonic()
+    applied = []
+
+    # Все миграции одной транзакцией: в Postgres DDL транзакционный,
+    # при ошибке схема остаётся в исходной версии
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Несколько процессов стартуют одновременно - миграции выполняет только один,
+            # остальные ждут не дольше lock_timeout
+            conn.execute(text(f"SET LOCAL lock_timeout = '{int(lock_timeout * 1000)}ms'"))
+            # Построение индексов на больших таблицах не должно упираться в statement_timeout сервиса
+            conn.execute(text("SET LOCAL statement_timeout = 0"))
+            conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "name VARCHAR(255) NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        done = {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+        for version, name, upgrade in sorted(migrations, key=lambda m: m[0]):
+            if version in done:
+                continue
+            upgrade(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+                {"version": version, "name": name}
+            )
+            applied.append(version)
+
+    return {"applied": applied, "elapsed": round(time.monotonic() - started, 3)}
+
+
+def schema_version(engine):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
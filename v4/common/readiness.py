@@ -0,0 +1,67 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from sqlalchemy import text
+
+# Проверки готовности: /manage/health - процесс жив, /manage/health/ready - доступны
+# зависимости (база, соседние сервисы). Все проверки выполняются параллельно и укладываются
+# в общий бюджет HEALTH_TIMEOUT; не успевшая проверка считается упавшей.
+
+HEALTH_TIMEOUT = float(os.environ.get("HEALTH_TIMEOUT", 1))
+
+health_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="health")
+
+
+def timed_check(check):
+    started = time.perf_counter()
+    try:
+        check()
+        result = {"status": "UP"}
+    except Exception as e:
+        result = {"status": "DOWN", "error": f"{type(e).__name__}: {e}"[:200]}
+    result["elapsedMs"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def run_checks(checks, timeout=HEALTH_TIMEOUT):
+    futures = {name: health_executor.submit(timed_check, check) for name, check in checks.items()}
+    wait(futures.values(), timeout=timeout)
+
+    results = {}
+    for name, future in futures.items():
+        if future.done():
+            results[name] = future.result()
+        else:
+            future.cancel()
+            results[name] = {"status": "DOWN", "error": f"timeout after {timeout}s"}
+    return results
+
+
+def summarize(results, required=None):
+    # required - проверки, без которых сервис не готов принимать запросы (по умолчанию все).
+    # Упавшая необязательная проверка даёт DEGRADED с кодом 200.
+    required = results.keys() if required is None else required
+    down = [name for name, result in results.items() if result["status"] != "UP"]
+    if any(name in required for name in down):
+        return {"status": "DOWN", "checks": results}, 503
+    return {"status": "DEGRADED" if down else "UP", "checks": results}, 200
+
+
+def database_check(app, db):
+    with app.app_context():
+        engine = db.engine
+
+    def check():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    return check
+
+
+def init_flask(app, checks, required=None):
+    from flask import jsonify
+
+    @app.route("/manage/health/ready", methods=["GET"])
+    def ready():
+        body, code = summarize(run_checks(checks), required)
+        return jsonify(body), code
@@ -0,0 +1,278 @@
+import contextvars
+import json
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Трассировка запросов между gateway и сервисами.
+# Контекст передаётся заголовком traceparent (формат W3C Trace Context): сервис продолжает
+# трассу вызывающего, а не начинает новую. Спаны пишутся на каждый входящий запрос,
+# каждый исходящий HTTP-вызов и каждый SQL-запрос.
+# Завершённые трассы складываются в кольцевой буфер процесса (GET /manage/traces) и, если
+# задан TRACE_FILE, дописываются в файл по одной JSON-строке на трассу. Каждый ответ
+# получает заголовок Server-Timing с суммарным временем по категориям (db, library, ...).
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+TRACE_FILE = os.environ.get("TRACE_FILE")
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 200))
+TRACE_SQL_LENGTH = 200
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    def __init__(self, trace_id, service, sampled):
+        self.trace_id = trace_id
+        self.service = service
+        # sampled влияет только на экспорт: Server-Timing считается для всех запросов
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.root = None
+        self.spans = []
+        self.lock = Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def timings(self):
+        # Суммарное время по категориям; параллельные вызовы одной категории складываются
+        totals = {}
+        counts = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span is self.root:
+                continue
+            totals[span.category] = totals.get(span.category, 0.0) + span.end - span.start
+            counts[span.category] = counts.get(span.category, 0) + 1
+        return totals, counts
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {
+            "traceId": self.trace_id,
+            "service": self.service,
+            "startedAt": self.started_at,
+            "durationMs": round((self.root.end - self.root.start) * 1000, 3),
+            "spans": [span.to_dict(self.origin) for span in spans],
+        }
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "category", "attributes", "start", "end")
+
+    def __init__(self, trace, parent_id, name, category, attributes=None):
+        self.trace = trace
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.category = category
+        self.attributes = attributes or {}
+        self.start = time.perf_counter()
+        self.end = None
+
+    def finish(self, **attributes):
+        self.attributes.update(attributes)
+        self.end = time.perf_counter()
+        self.trace.add(self)
+
+    def to_dict(self, origin):
+        return {
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "name": self.name,
+            "category": self.category,
+            "offsetMs": round((self.start - origin) * 1000, 3),
+            "durationMs": round((self.end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+# -------------------- Экспорт --------------------
+class TraceExporter:
+    def __init__(self, path, size):
+        self.path = path
+        self.recent = deque(maxlen=size)
+        self.lock = Lock()
+        self.file = None
+        self.pid = None
+
+    def export(self, trace):
+        record = trace.to_dict()
+        self.recent.append(record)
+        if not self.path:
+            return
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self.lock:
+            # Файл открывается заново в каждом процессе после fork; O_APPEND не даёт
+            # воркерам gunicorn перезаписывать строки друг друга
+            if self.pid != os.getpid():
+                self.file = open(self.path, "a", buffering=1, encoding="utf-8")
+                self.pid = os.getpid()
+            self.file.write(line)
+
+    def traces(self, limit=None, trace_id=None):
+        records = list(self.recent)
+        if trace_id:
+            records = [record for record in records if record["traceId"] == trace_id]
+        records.reverse()
+        return records[:limit] if limit else records
+
+
+exporter = TraceExporter(TRACE_FILE, TRACE_BUFFER_SIZE)
+
+
+# -------------------- Контекст трассы --------------------
+def parse_traceparent(value):
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def start_request(service, name, traceparent=None):
+    parent = parse_traceparent(traceparent)
+    if parent:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id = "%032x" % random.getrandbits(128)
+        parent_id = None
+        sampled = random.random() < TRACE_SAMPLE_RATE
+
+    trace = Trace(trace_id, service, sampled)
+    span = Span(trace, parent_id, name, "server")
+    trace.root = span
+    return span, _current_span.set(span)
+
+
+def finish_request(span, token, **attributes):
+    _current_span.reset(token)
+    span.finish(**attributes)
+    if span.trace.sampled:
+        exporter.export(span.trace)
+
+
+def server_timing(span):
+    totals, counts = span.trace.timings()
+    parts = [
+        f'{category};dur={seconds * 1000:.1f};desc="{counts[category]}"'
+        for category, seconds in sorted(totals.items())
+    ]
+    parts.append(f"total;dur={(time.perf_counter() - span.start) * 1000:.1f}")
+    parts.append(f'trace;desc="{span.trace.trace_id}"')
+    return ", ".join(parts)
+
+
+@contextmanager
+def span(name, category, **attributes):
+    parent = _current_span.get()
+    if parent is None:
+        # Вне запроса (фоновые потоки) спаны не пишутся
+        yield None
+        return
+
+    child = Span(parent.trace, parent.span_id, name, category, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+
+def inject(headers):
+    current = _current_span.get()
+    if current is not None:
+        flags = "01" if current.trace.sampled else "00"
+        headers["traceparent"] = f"00-{current.trace.trace_id}-{current.span_id}-{flags}"
+    return headers
+
+
+def in_context(func):
+    # ThreadPoolExecutor не переносит contextvars в поток - переносим явно
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+# -------------------- SQLAlchemy --------------------
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = _current_span.get()
+    if parent is None:
+        return
+    conn.info.setdefault("trace_spans", []).append(
+        Span(parent.trace, parent.span_id, "sql", "db", {"statement": statement[:TRACE_SQL_LENGTH]})
+    )
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("trace_spans")
+    if spans:
+        spans.pop().finish(rows=cursor.rowcount)
+
+
+def _handle_error(context):
+    conn = context.connection
+    spans = conn.info.get("trace_spans") if conn is not None else None
+    if spans:
+        spans.pop().finish(error=type(context.original_exception).__name__)
+
+
+def instrument_sqlalchemy():
+    if event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+
+# -------------------- Flask --------------------
+def init_flask(app, service):
+    from flask import g, jsonify, request
+
+    instrument_sqlalchemy()
+
+    @app.before_request
+    def start_trace():
+        rule = request.url_rule.rule if request.url_rule else request.path
+        g.trace = start_request(service, f"{request.method} {rule}", request.headers.get("traceparent"))
+
+    @app.after_request
+    def add_server_timing(response):
+        current = g.get("trace")
+        if current is not None:
+            current[0].attributes["status"] = response.status_code
+            response.headers["Server-Timing"] = server_timing(current[0])
+        return response
+
+    @app.teardown_request
+    def finish_trace(exc):
+        current = g.pop("trace", None)
+        if current is not None:
+            if exc is not None:
+                current[0].attributes["error"] = type(exc).__name__
+            finish_request(*current)
+
+    @app.route("/manage/traces", methods=["GET"])
+    def recent_traces():
+        limit = request.args.get("limit", default=50, type=int)
+        return jsonify(exporter.traces(limit, request.args.get("traceId"))), 200
@@ -1,169 +1,978 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
+import hashlib
+import json
+import os
+import random
+import sqlite3
 import time
-from threading import Lock, Thread
-from queue import Queue, Empty
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Event, Lock, Thread
+from urllib.parse import urlsplit
+from uuid import uuid4
 
-rating_queue = Queue()
-#  
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from common import metrics, readiness, tracing
 
 
 class CircuitBreaker:
-    def __init__(self, failure_threshold=3, retry_timeout=10):
-        self.failure_threshold = failure_threshold
+    # Статистика копится в скользящем окне из посекундных корзин. Breaker размыкается,
+    # если за окно (не меньше minimum_calls вызовов) доля ошибок или медленных вызовов
+    # превысила порог. В HALF_OPEN пропускается не больше half_open_max_calls пробных запросов.
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, name, fallback_message, failure_rate_threshold=0.5, slow_call_rate_threshold=0.8,
+                 slow_call_duration=1.0, window_seconds=10, minimum_calls=3, retry_timeout=10,
+                 half_open_max_calls=1):
+        self.name = name
+        self.fallback_message = fallback_message
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.window_seconds = window_seconds
+        self.minimum_calls = minimum_calls
         self.retry_timeout = retry_timeout
-        self.failure_count = 0
-        self.state = "CLOSED" 
-        self.last_failure_time = None
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = "CLOSED"
+        self.opened_at = None
+        self.half_open_calls = 0
         self.lock = Lock()
 
+        # [секунда, вызовы, ошибки, медленные] на каждую секунду окна
+        self.window = [[0, 0, 0, 0] for _ in range(window_seconds)]
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.rejected = 0
+        self.transitions = {"CLOSED": 0, "OPEN": 0, "HALF_OPEN": 0}
+
     def call(self, func, *args, **kwargs):
-        with self.lock:
-            if self.state == "OPEN":
-                if time.time() - self.last_failure_time > self.retry_timeout:
-                    self.state = "HALF_OPEN"
-                else:
-                    return self.fallback(*args, **kwargs)
+        return self.call_tracked({}, func, *args, **kwargs)
 
+    def call_tracked(self, ticket, func, *args, **kwargs):
+        # ticket - dict, общий с вызывающим: если тот перестал ждать и вызвал abandon(ticket),
+        # вызов уже записан как отказ, и поздний результат в статистику не попадает
+        permission = self._acquire()
+        if not permission:
+            return self.fallback(*args, **kwargs)
+
+        ticket.update(permission=permission, started=time.monotonic())
         try:
             result = func(*args, **kwargs)
         except Exception:
-            with self.lock:
-                self.failure_count += 1
-                self.last_failure_time = time.time()
-                if self.failure_count >= self.failure_threshold:
-                    self.state = "OPEN"
+            self._finish(ticket, True)
             return self.fallback(*args, **kwargs)
 
-        with self.lock:
-            self.failure_count = 0
-            self.state = "CLOSED"
+        self._finish(ticket, False)
         return result
 
+    def abandon(self, ticket):
+        # Вызов не уложился в deadline fan_out - считаем отказом сразу, не дожидаясь HTTP_TIMEOUT
+        self._finish(ticket, True)
+
+    def _finish(self, ticket, failed):
+        with self.lock:
+            if "started" not in ticket or ticket.get("finished"):
+                return
+            ticket["finished"] = True
+        self._record(time.monotonic() - ticket["started"], failed, ticket["permission"] == "probe")
+
     def fallback(self, *args, **kwargs):
-        return {"message": "Bonus Service unavailable"}
-    
-library_cb = CircuitBreaker(failure_threshold=3, retry_timeout=10)
-rating_cb = CircuitBreaker(failure_threshold=3, retry_timeout=10)
-reservation_cb = CircuitBreaker(failure_threshold=3, retry_timeout=10)
+        return {"message": self.fallback_message}
+
+    def _acquire(self):
+        with self.lock:
+            if self.state == "CLOSED":
+                return "call"
+            if self.state == "OPEN":
+                if time.monotonic() - self.opened_at < self.retry_timeout:
+                    self.rejected += 1
+                    return None
+                self._transition("HALF_OPEN")
+            if self.half_open_calls >= self.half_open_max_calls:
+                self.rejected += 1
+                return None
+            self.half_open_calls += 1
+            return "probe"
+
+    def _record(self, elapsed, failed, probe):
+        slow = elapsed >= self.slow_call_duration
+        second = int(time.monotonic())
+        with self.lock:
+            self.latency_sum += elapsed
+            self.latency_counts[self._latency_bucket(elapsed)] += 1
+
+            bucket = self.window[second % self.window_seconds]
+            if bucket[0] != second:
+                bucket[:] = [second, 0, 0, 0]
+            bucket[1] += 1
+            bucket[2] += failed
+            bucket[3] += slow
+
+            if probe:
+                self.half_open_calls -= 1
+                if self.state == "HALF_OPEN":
+                    self._transition("OPEN" if failed or slow else "CLOSED")
+                return
+
+            # Успешный быстрый вызов долю ошибок не увеличивает - окно не пересчитываем
+            if self.state == "CLOSED" and (failed or slow):
+                calls, failures, slow_calls = self._window_totals(second)
+                if calls >= self.minimum_calls and (
+                    failures / calls >= self.failure_rate_threshold
+                    or slow_calls / calls >= self.slow_call_rate_threshold
+                ):
+                    self._transition("OPEN")
+
+    def _latency_bucket(self, elapsed):
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if elapsed <= bound:
+                return i
+        return len(self.LATENCY_BUCKETS)
+
+    def _window_totals(self, second):
+        calls = failures = slow_calls = 0
+        for bucket_second, bucket_calls, bucket_failures, bucket_slow in self.window:
+            if second - bucket_second < self.window_seconds:
+                calls += bucket_calls
+                failures += bucket_failures
+                slow_calls += bucket_slow
+        return calls, failures, slow_calls
+
+    def _transition(self, state):
+        self.state = state
+        self.transitions[state] += 1
+        if state == "OPEN":
+            self.opened_at = time.monotonic()
+        elif state == "CLOSED":
+            # После восстановления старые ошибки не должны снова разомкнуть breaker
+            for bucket in self.window:
+                bucket[:] = [0, 0, 0, 0]
+
+    def stats(self):
+        with self.lock:
+            calls, failures, slow_calls = self._window_totals(int(time.monotonic()))
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.LATENCY_BUCKETS + ("+Inf",), self.latency_counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {
+                "name": self.name,
+                "state": self.state,
+                "transitions": dict(self.transitions),
+                "rejected": self.rejected,
+                "window": {"calls": calls, "failures": failures, "slow": slow_calls},
+                "latency": {"buckets": buckets, "count": cumulative, "sum": round(self.latency_sum, 6)}
+            }
+
+
+library_cb = CircuitBreaker("library", "Library Service unavailable")
+rating_cb = CircuitBreaker("rating", "Bonus Service unavailable")
+reservation_cb = CircuitBreaker("reservation", "Reservation Service unavailable")
+
+
+# -------------------- Параллельные запросы (fan-out) --------------------
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", 32))
+FANOUT_DEADLINE = float(os.environ.get("FANOUT_DEADLINE", 3))
+
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+
+def fan_out(calls, deadline=FANOUT_DEADLINE):
+    # calls: {имя: (circuit_breaker, func, *args)}
+    # Все независимые запросы выполняются параллельно, каждый через свой Circuit Breaker.
+    # Если запрос не уложился в общий deadline, вместо результата отдаётся fallback,
+    # а в breaker записывается отказ. Уже начатый запрос поток не прервать (cancel отменяет
+    # только ждущие в очереди): worker пула занят им до HTTP_TIMEOUT, а не до FANOUT_DEADLINE,
+    # поэтому FANOUT_WORKERS рассчитывается на запросы длительностью до HTTP_TIMEOUT.
+    tickets = {name: {} for name in calls}
+    futures = {
+        name: fanout_executor.submit(tracing.in_context(cb.call_tracked), tickets[name], func, *args)
+        for name, (cb, func, *args) in calls.items()
+    }
+    wait(futures.values(), timeout=deadline)
+
+    results = {}
+    for name, future in futures.items():
+        cb = calls[name][0]
+        if future.done():
+            results[name] = future.result()
+        else:
+            if not future.cancel():
+                cb.abandon(tickets[name])
+            results[name] = cb.fallback()
+    return results
+
 
 app = Flask(__name__)
+tracing.init_flask(app, "gateway")
+metrics_registry = metrics.init_flask(app, "gateway")
 
 LIBRARY_URL = "http://library_service:8060"
 RATING_URL = "http://rating_service:8050"
 RESERVATION_URL = "http://reservation_service:8070"
 
+
+# -------------------- Кэш метаданных библиотек и книг --------------------
+CACHE_MAXSIZE = int(os.environ.get("CACHE_MAXSIZE", 1024))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 300))
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+
+
+class RedisCacheBackend:
+    # Общий кэш для нескольких реплик gateway. Ошибки Redis не должны ломать запрос,
+    # поэтому при любой ошибке backend ведёт себя как промах.
+    def __init__(self, url, prefix):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except redis.RedisError:
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+        except redis.RedisError:
+            pass
+
+    def delete(self, key=None):
+        try:
+            if key is not None:
+                self.client.delete(self.prefix + key)
+            else:
+                keys = list(self.client.scan_iter(self.prefix + "*"))
+                if keys:
+                    self.client.delete(*keys)
+        except redis.RedisError:
+            pass
+
+
+class TTLCache:
+    # LRU + TTL кэш в памяти процесса. Просроченные записи не удаляются сразу:
+    # они остаются до вытеснения и отдаются как stale, когда сервис недоступен.
+    def __init__(self, maxsize=1024, ttl=300, backend=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[0] > now:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self._store(key, value)
+                with self.lock:
+                    self.hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def get_stale(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            self.stale_hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        self._store(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value, self.ttl)
+
+    def _store(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def get_many(self, keys):
+        # -> (найденные значения, ключи которых нет в кэше)
+        found, missing = {}, []
+        for key in keys:
+            value = self.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        return found, missing
+
+    def fill(self, keys, loaded):
+        # loaded - ответ сервиса или fallback Circuit Breaker'а.
+        # При fallback отдаём то, что осталось в кэше, пусть и устаревшее.
+        if "message" in loaded:
+            stale = {}
+            for key in keys:
+                value = self.get_stale(key)
+                if value is not None:
+                    stale[key] = value
+            return stale
+        for key, value in loaded.items():
+            self.set(key, value)
+        return loaded
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.data.clear()
+            else:
+                self.data.pop(key, None)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "staleHits": self.stale_hits,
+                "evictions": self.evictions
+            }
+
+
+def make_cache(prefix):
+    backend = None
+    if CACHE_REDIS_URL and redis is not None:
+        backend = RedisCacheBackend(CACHE_REDIS_URL, prefix)
+    return TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL, backend=backend)
+
+
+book_cache = make_cache("gateway:book:")
+library_cache = make_cache("gateway:library:")
+
+
+# -------------------- HTTP-клиенты с пулом соединений --------------------
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 32))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 0.5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 2))
+HTTP_GET_RETRIES = int(os.environ.get("HTTP_GET_RETRIES", 2))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", 0.1))
+
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+class TracedSession(requests.Session):
+    # Каждый исходящий запрос - спан с категорией сервиса, контекст трассы уходит заголовком traceparent
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def request(self, method, url, *args, headers=None, **kwargs):
+        with tracing.span(f"{method} {urlsplit(url).path}", self.service) as span:
+            resp = super().request(method, url, *args, headers=tracing.inject(dict(headers or {})), **kwargs)
+            if span is not None:
+                span.attributes["status"] = resp.status_code
+            return resp
+
+
+def make_session(service):
+    # Одна keep-alive сессия на сервис: соединения переиспользуются между запросами.
+    # Повторы с backoff только для идемпотентных GET, POST/PATCH не повторяются.
+    retry = Retry(
+        total=HTTP_GET_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        allowed_methods=frozenset(["GET"]),
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = TracedSession(service)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+library_http = make_session("library")
+rating_http = make_session("rating")
+reservation_http = make_session("reservation")
+
+# -------------------- Очередь обновлений рейтинга (outbox) --------------------
+RATING_OUTBOX_PATH = os.environ.get("RATING_OUTBOX_PATH", "rating_outbox.db")
+RATING_BATCH_SIZE = int(os.environ.get("RATING_BATCH_SIZE", 100))
+RATING_RETRY_BASE = float(os.environ.get("RATING_RETRY_BASE", 1))
+# Не реже раза в 10 секунд: по заданию отложенные изменения рейтинга повторяются с таким
+# интервалом, и после рестарта rating_service очередь доезжает без долгого ожидания
+RATING_RETRY_MAX = float(os.environ.get("RATING_RETRY_MAX", 10))
+RATING_CLAIM_LEASE = float(os.environ.get("RATING_CLAIM_LEASE", 30))
+RATING_POLL_INTERVAL = float(os.environ.get("RATING_POLL_INTERVAL", 1))
+
+
+def retry_schedule(items):
+    # items - [(ключ записи, attempts)] -> [(attempts + 1, next_attempt_at, ключ)] для UPDATE.
+    # Экспоненциальный backoff с разбросом, не дольше RATING_RETRY_MAX
+    now = time.time()
+    return [
+        (attempts + 1, now + min(RATING_RETRY_MAX, RATING_RETRY_BASE * 2 ** attempts) * random.uniform(0.5, 1), key)
+        for key, attempts in items
+    ]
+
+
+class RatingOutbox:
+    # Отложенные изменения рейтинга в локальной SQLite: переживают рестарт gateway.
+    # Каждая запись повторяется со своим экспоненциальным backoff, поэтому одна
+    # "застрявшая" запись не задерживает остальные.
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.conn = None
+        self.conn_pid = None
+        # Счётчики процесса для /manage/metrics
+        self.enqueued = 0
+        self.delivered = 0
+        self.retried = 0
+
+    def _connection(self):
+        # Соединение SQLite нельзя наследовать через fork - в каждом процессе своё
+        if self.conn_pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            self.conn_pid = os.getpid()
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rating_outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "user_name TEXT NOT NULL, "
+                "delta INTEGER NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_rating_outbox_next_attempt_at ON rating_outbox (next_attempt_at)"
+            )
+        return self.conn
+
+    def put(self, user_name, delta):
+        now = time.time()
+        with self.lock:
+            self._connection().execute(
+                "INSERT INTO rating_outbox (user_name, delta, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (user_name, delta, now, now)
+            )
+            self.enqueued += 1
+        self.wakeup.set()
+
+    def claim(self, limit):
+        # Забираем готовые к отправке записи и сдвигаем их срок на время аренды:
+        # другой процесс gateway с тем же файлом их не возьмёт
+        now = time.time()
+        with self.lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, user_name, delta, attempts FROM rating_outbox "
+                    "WHERE next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE rating_outbox SET next_attempt_at = ? WHERE id = ?",
+                    [(now + RATING_CLAIM_LEASE, row[0]) for row in rows]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def ack(self, rows):
+        with self.lock:
+            self._connection().executemany("DELETE FROM rating_outbox WHERE id = ?", [(row[0],) for row in rows])
+            self.delivered += len(rows)
+
+    def retry(self, rows):
+        updates = retry_schedule((item_id, attempts) for item_id, _, _, attempts in rows)
+        with self.lock:
+            self._connection().executemany(
+                "UPDATE rating_outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?", updates
+            )
+            self.retried += len(rows)
+
+    def depth(self):
+        with self.lock:
+            return self._connection().execute("SELECT COUNT(*) FROM rating_outbox").fetchone()[0]
+
+    def stats(self):
+        depth = self.depth()
+        with self.lock:
+            return {"depth": depth, "enqueued": self.enqueued, "delivered": self.delivered, "retried": self.retried}
+
+    def wait(self, timeout):
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+
+rating_queue = RatingOutbox(RATING_OUTBOX_PATH)
+
+
 def rating_queue_worker():
     while True:
         try:
-            task = rating_queue.get(timeout=5)
-        except Empty:
+            rows = rating_queue.claim(RATING_BATCH_SIZE)
+        except sqlite3.Error:
+            time.sleep(RATING_POLL_INTERVAL)
             continue
 
-        user_name = task["user_name"]
-        delta = task["delta"]
+        if not rows:
+            rating_queue.wait(RATING_POLL_INTERVAL)
+            continue
+
+        # Несколько изменений одного пользователя сворачиваем в одно
+        deltas = {}
+        for _, user_name, delta, _ in rows:
+            deltas[user_name] = deltas.get(user_name, 0) + delta
 
         try:
-            # 1. Получаем ТЕКУЩИЙ рейтинг
-            resp = requests.get(
-                f"{RATING_URL}/rating",
-                headers={"X-User-Name": user_name},
-                timeout=2
+            apply_rating_bulk(deltas)
+        except Exception:
+            # сервис всё ещё недоступен
+            rating_queue.retry(rows)
+            continue
+
+        rating_queue.ack(rows)
+
+
+# -------------------- Идемпотентность и компенсации (saga) --------------------
+IDEMPOTENCY_PATH = os.environ.get("IDEMPOTENCY_PATH", "idempotency.db")
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 86400))
+IDEMPOTENCY_LEASE = float(os.environ.get("IDEMPOTENCY_LEASE", 30))
+
+
+class SagaLog:
+    # Ключи идемпотентности клиентов (Idempotency-Key) с сохранёнными ответами и
+    # невыполненные шаги по складу. Хранится в SQLite, общей для всех процессов gateway,
+    # как и outbox рейтинга.
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.conn = None
+        self.conn_pid = None
+        self.replayed = 0
+        self.compensations = 0
+
+    def _connection(self):
+        if self.conn_pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            self.conn_pid = os.getpid()
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+                "scope TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, "
+                "operation_id TEXT NOT NULL, "
+                "status_code INTEGER, "
+                "body TEXT, "
+                "locked_until REAL NOT NULL, "
+                "expires_at REAL NOT NULL, "
+                "PRIMARY KEY (scope, key))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS stock_outbox ("
+                "operation_id TEXT PRIMARY KEY, "
+                "action TEXT NOT NULL, "
+                "library_uid TEXT, "
+                "book_uid TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL)"
+            )
+        return self.conn
+
+    def begin(self, scope, key, fingerprint):
+        # -> ("new", operation_id) | ("replay", (status_code, body)) | ("busy", None) | ("mismatch", None)
+        now = time.time()
+        with self.lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT fingerprint, operation_id, status_code, body, locked_until, expires_at "
+                    "FROM idempotency_keys WHERE scope = ? AND key = ?",
+                    (scope, key)
+                ).fetchone()
+                if row is not None and row[5] < now:
+                    conn.execute("DELETE FROM idempotency_keys WHERE scope = ? AND key = ?", (scope, key))
+                    row = None
+
+                if row is None:
+                    result = ("new", str(uuid4()))
+                    conn.execute(
+                        "INSERT INTO idempotency_keys (scope, key, fingerprint, operation_id, locked_until, expires_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (scope, key, fingerprint, result[1], now + IDEMPOTENCY_LEASE, now + IDEMPOTENCY_TTL)
+                    )
+                elif row[0] != fingerprint:
+                    result = ("mismatch", None)
+                elif row[2] is not None:
+                    self.replayed += 1
+                    result = ("replay", (row[2], row[3]))
+                elif row[4] > now:
+                    result = ("busy", None)
+                else:
+                    # Предыдущая попытка оборвалась на середине - продолжаем с тем же operation_id:
+                    # уже выполненные шаги сервисы узнают по нему и не повторяют
+                    conn.execute(
+                        "UPDATE idempotency_keys SET locked_until = ? WHERE scope = ? AND key = ?",
+                        (now + IDEMPOTENCY_LEASE, scope, key)
+                    )
+                    result = ("new", row[1])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def complete(self, scope, key, status_code, body):
+        with self.lock:
+            self._connection().execute(
+                "UPDATE idempotency_keys SET status_code = ?, body = ? WHERE scope = ? AND key = ?",
+                (status_code, body, scope, key)
+            )
+
+    def release(self, scope, key):
+        # Временная ошибка: ответ не запоминаем, повтор клиента выполнит запрос заново
+        with self.lock:
+            self._connection().execute("DELETE FROM idempotency_keys WHERE scope = ? AND key = ?", (scope, key))
+
+    def purge(self):
+        with self.lock:
+            self._connection().execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (time.time(),))
+
+    def compensate(self, operation_id, action, library_uid=None, book_uid=None):
+        # action: "cancel" - отменить списание со склада, "increment" - вернуть книгу на склад
+        now = time.time()
+        with self.lock:
+            self._connection().execute(
+                "INSERT OR IGNORE INTO stock_outbox (operation_id, action, library_uid, book_uid, next_attempt_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (operation_id, action, library_uid, book_uid, now)
             )
-            resp.raise_for_status()
-            current = resp.json().get("stars", 1)
+            self.compensations += 1
+        self.wakeup.set()
 
-            # 2. Применяем операцию
-            new_stars = current + delta
+    def claim(self, limit):
+        now = time.time()
+        with self.lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT operation_id, action, library_uid, book_uid, attempts FROM stock_outbox "
+                    "WHERE next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE stock_outbox SET next_attempt_at = ? WHERE operation_id = ?",
+                    [(now + RATING_CLAIM_LEASE, row[0]) for row in rows]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return rows
 
-            # 3. Обновляем рейтинг
-            requests.post(
-                f"{RATING_URL}/rating",
-                json={"username": user_name, "stars": new_stars},
-                timeout=2
+    def ack(self, rows):
+        with self.lock:
+            self._connection().executemany(
+                "DELETE FROM stock_outbox WHERE operation_id = ?", [(row[0],) for row in rows]
             )
 
-            rating_queue.task_done()
+    def retry(self, rows):
+        updates = retry_schedule((operation_id, attempts) for operation_id, _, _, _, attempts in rows)
+        with self.lock:
+            self._connection().executemany(
+                "UPDATE stock_outbox SET attempts = ?, next_attempt_at = ? WHERE operation_id = ?", updates
+            )
 
-        except Exception:
-            # сервис всё ещё недоступен
-            rating_queue.put(task)
-            rating_queue.task_done()
-            time.sleep(3)
+    def depth(self):
+        with self.lock:
+            return self._connection().execute("SELECT COUNT(*) FROM stock_outbox").fetchone()[0]
 
+    def wait(self, timeout):
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
 
-Thread(target=rating_queue_worker, daemon=True).start()
+
+saga_log = SagaLog(IDEMPOTENCY_PATH)
+
+
+def run_stock_action(operation_id, action, library_uid, book_uid):
+    if action == "cancel":
+        return cancel_stock(operation_id)
+    return release_stock(library_uid, book_uid, operation_id)
+
+
+def stock_outbox_worker():
+    # Шаги по складу, не выполненные в запросе (Library Service недоступен).
+    # Library Service применяет каждую операцию по operation_id один раз, поэтому повтор безопасен.
+    while True:
+        try:
+            rows = saga_log.claim(RATING_BATCH_SIZE)
+        except sqlite3.Error:
+            time.sleep(RATING_POLL_INTERVAL)
+            continue
+
+        if not rows:
+            try:
+                saga_log.purge()
+            except sqlite3.Error:
+                pass
+            saga_log.wait(RATING_POLL_INTERVAL)
+            continue
+
+        done, failed = [], []
+        for row in rows:
+            try:
+                run_stock_action(*row[:4])
+                done.append(row)
+            except requests.HTTPError as e:
+                # 4xx (книги или библиотеки больше нет) повтором не исправить
+                (done if e.response.status_code < 500 else failed).append(row)
+            except requests.RequestException:
+                failed.append(row)
+        saga_log.ack(done)
+        saga_log.retry(failed)
+
+
+_background_pid = None
+_background_lock = Lock()
+
+
+def start_background_workers():
+    # Потоки не переживают fork: при нескольких процессах gunicorn (в том числе с preload)
+    # каждый процесс запускает своего обработчика очереди. Outbox общий, записи
+    # разбираются через аренду, поэтому двойного применения нет.
+    global _background_pid
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+        Thread(target=rating_queue_worker, daemon=True).start()
+        Thread(target=stock_outbox_worker, daemon=True).start()
+
+
+@app.before_request
+def ensure_background_workers():
+    if _background_pid != os.getpid():
+        start_background_workers()
 
 
 # -------------------- Вспомогательные функции для запросов --------------------
-def fetch_libraries(city, page, size):
-    params = {"city": city, "page": page, "size": size}
-    resp = requests.get(f"{LIBRARY_URL}/libraries", params=params, timeout=2)
+# История броней читается из reservation_service страницами такого размера
+RESERVATION_PAGE_SIZE = int(os.environ.get("RESERVATION_PAGE_SIZE", 200))
+# Пакетные бронирование и возврат - не больше MAX_BATCH_ITEMS книг за запрос
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 50))
+# UID для /books/batch и /libraries/batch уходят в строке запроса - не больше LOOKUP_CHUNK_SIZE
+# за запрос, иначе длинная страница истории упирается в limit_request_line gunicorn (400)
+LOOKUP_CHUNK_SIZE = int(os.environ.get("LOOKUP_CHUNK_SIZE", 50))
+
+
+def uid_chunks(uids):
+    uids = list(uids)
+    return [uids[start:start + LOOKUP_CHUNK_SIZE] for start in range(0, len(uids), LOOKUP_CHUNK_SIZE)]
+
+
+def fetch_libraries(city, page, size, cursor=None, count=None):
+    params = {"city": city, "page": page, "size": size, "cursor": cursor, "count": count}
+    resp = library_http.get(f"{LIBRARY_URL}/libraries", params=params, timeout=HTTP_TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
-def fetch_books(library_uid, page, size, show_all):
-    params = {"page": page, "size": size, "showAll": show_all}
-    resp = requests.get(f"{LIBRARY_URL}/libraries/{library_uid}/books", params=params, timeout=2)
+def fetch_books(library_uid, page, size, show_all, cursor=None, count=None):
+    params = {"page": page, "size": size, "showAll": show_all, "cursor": cursor, "count": count}
+    resp = library_http.get(f"{LIBRARY_URL}/libraries/{library_uid}/books", params=params, timeout=HTTP_TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
 def fetch_rating(user_name):
     headers = {"X-User-Name": user_name}
-    resp = requests.get(f"{RATING_URL}/rating", headers=headers, timeout=2)
+    resp = rating_http.get(f"{RATING_URL}/rating", headers=headers, timeout=HTTP_TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
-def fetch_reservations(user_name):
-    # Получаем все бронирования пользователя
-    resp = requests.get(f"{RESERVATION_URL}/reservations/{user_name}", timeout=2)
+def apply_rating_delta(user_name, delta):
+    resp = rating_http.post(
+        f"{RATING_URL}/rating/delta",
+        json={"username": user_name, "delta": delta},
+        timeout=HTTP_TIMEOUT
+    )
     resp.raise_for_status()
-    reservations_json = resp.json()
-    result = []
-
-    for reservation in reservations_json:
-        reservation_uid = reservation.get("reservationUid")
-        book_uid = reservation.get("bookUid")
-        library_uid = reservation.get("libraryUid")
-        start_date = reservation.get("startDate")
-        till_date = reservation.get("tillDate")
-        status = reservation.get("status", "RENTED")
-
-        # Получаем информацию о книге
-        book_data = {}
-        if book_uid and library_uid:
-            book_resp = requests.get(f"{LIBRARY_URL}/libraries/{library_uid}/{book_uid}", timeout=2)
-            if book_resp.status_code == 200:
-                book_data = book_resp.json()
-
-        # Получаем информацию о библиотеке
-        library_data = {}
-        if library_uid:
-            library_resp = requests.get(f"{LIBRARY_URL}/libraries/{library_uid}", timeout=2)
-            if library_resp.status_code == 200:
-                library_data = library_resp.json()
-
-        result.append({
-            "reservationUid": reservation_uid,
-            "status": status,
-            "startDate": start_date,
-            "tillDate": till_date,
-            "book": {
-                "bookUid": book_uid,
-                "name": book_data.get("name", ""),
-                "author": book_data.get("author", ""),
-                "genre": book_data.get("genre", "")
-            },
-            "library": {
-                "libraryUid": library_uid,
-                "name": library_data.get("name", ""),
-                "address": library_data.get("address", ""),
-                "city": library_data.get("city", "")
-            }
-        })
+    return resp.json()
+
+def apply_rating_bulk(deltas):
+    updates = [{"username": user_name, "delta": delta} for user_name, delta in deltas.items()]
+    resp = rating_http.post(f"{RATING_URL}/rating/bulk", json={"updates": updates}, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()
+
+def reserve_stock(library_uid, book_uid, operation_id):
+    # Составной вызов: проверка книги и библиотеки, атомарное списание экземпляра и метаданные.
+    # 409 - книги нет в наличии, это не сбой сервиса
+    resp = library_http.post(
+        f"{LIBRARY_URL}/libraries/{library_uid}/books/{book_uid}/reserve",
+        headers={"X-Operation-Id": operation_id}, timeout=HTTP_TIMEOUT
+    )
+    if resp.status_code == 409:
+        return {"available": False}
+    resp.raise_for_status()
+    return {"available": True, **resp.json()}
+
+def release_stock(library_uid, book_uid, operation_id):
+    resp = library_http.patch(
+        f"{LIBRARY_URL}/libraries/{library_uid}/books/{book_uid}/increment",
+        headers={"X-Operation-Id": operation_id}, timeout=HTTP_TIMEOUT
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+def reserve_stock_batch(items):
+    # items - [{"libraryUid", "bookUid", "operationId"}], списание одной транзакцией library_service.
+    # 404/409 - какой-то книги нет в библиотеке или в наличии, пакет не применён
+    resp = library_http.post(f"{LIBRARY_URL}/stock/reserve", json={"items": items}, timeout=HTTP_TIMEOUT)
+    if resp.status_code in (404, 409):
+        return {"available": False, "status": resp.status_code, "reason": resp.json()}
+    resp.raise_for_status()
+    return {"available": True, **resp.json()}
+
+def release_stock_batch(items):
+    resp = library_http.post(f"{LIBRARY_URL}/stock/release", json={"items": items}, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()
+
+def cancel_stock(operation_id):
+    resp = library_http.post(f"{LIBRARY_URL}/stock-operations/{operation_id}/cancel", timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()
+
+def fetch_libraries_batch(library_uids):
+    # Библиотеки пачками по LOOKUP_CHUNK_SIZE, ключ - libraryUid
+    libraries = {}
+    for chunk in uid_chunks(library_uids):
+        params = {"libraryUid": chunk}
+        resp = library_http.get(f"{LIBRARY_URL}/libraries/batch", params=params, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        libraries.update({item["libraryUid"]: item for item in resp.json().get("items", [])})
+    return libraries
+
+def fetch_books_batch(book_uids):
+    # Книги пачками по LOOKUP_CHUNK_SIZE, ключ - bookUid
+    books = {}
+    for chunk in uid_chunks(book_uids):
+        params = {"bookUid": chunk}
+        resp = library_http.get(f"{LIBRARY_URL}/books/batch", params=params, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        books.update({item["bookUid"]: item for item in resp.json().get("items", [])})
+    return books
+
+def plan_metadata(book_uids, library_uids):
+    # Берём из кэша всё, что есть; в library_service идём только за недостающим
+    books, missing_books = book_cache.get_many(book_uids)
+    libraries, missing_libraries = library_cache.get_many(library_uids)
+    calls = {}
+    if missing_books:
+        calls["books"] = (library_cb, fetch_books_batch, missing_books)
+    if missing_libraries:
+        calls["libraries"] = (library_cb, fetch_libraries_batch, missing_libraries)
+    return books, libraries, calls
+
+def fill_metadata(books, libraries, calls, lookups):
+    if "books" in calls:
+        books.update(book_cache.fill(calls["books"][2], lookups["books"]))
+    if "libraries" in calls:
+        libraries.update(library_cache.fill(calls["libraries"][2], lookups["libraries"]))
+
+def book_view(book_uid, book_data):
+    return {
+        "bookUid": book_uid,
+        "name": book_data.get("name", ""),
+        "author": book_data.get("author", ""),
+        "genre": book_data.get("genre", "")
+    }
+
+def library_view(library_uid, library_data):
+    return {
+        "libraryUid": library_uid,
+        "name": library_data.get("name", ""),
+        "address": library_data.get("address", ""),
+        "city": library_data.get("city", "")
+    }
+
+def reservation_view(reservation, books, libraries):
+    book_uid = reservation.get("bookUid")
+    library_uid = reservation.get("libraryUid")
+    book_data = books.get(book_uid, {}) if library_uid else {}
+    library_data = libraries.get(library_uid, {})
+    return {
+        "reservationUid": reservation.get("reservationUid"),
+        "status": reservation.get("status", "RENTED"),
+        "startDate": reservation.get("startDate"),
+        "tillDate": reservation.get("tillDate"),
+        "book": book_view(book_uid, book_data),
+        "library": library_view(library_uid, library_data)
+    }
+
+def reservation_uids(reservations_json):
+    # Уникальные uid книг и библиотек - по одному пакетному запросу на каждый тип
+    book_uids = list(dict.fromkeys(
+        r.get("bookUid") for r in reservations_json if r.get("bookUid") and r.get("libraryUid")
+    ))
+    library_uids = list(dict.fromkeys(
+        r.get("libraryUid") for r in reservations_json if r.get("libraryUid")
+    ))
+    return book_uids, library_uids
+
+def fetch_reservation_page(user_name, cursor, size, status=None):
+    # Одна страница истории с книгами и библиотеками; метаданные - только для книг этой страницы
+    params = {"cursor": cursor, "size": size, "status": status}
+    resp = reservation_http.get(f"{RESERVATION_URL}/reservations/{user_name}", params=params, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    page = resp.json()
+
+    book_uids, library_uids = reservation_uids(page["items"])
+
+    # Книги и библиотеки не зависят друг от друга - недостающие запрашиваем параллельно
+    books, libraries, calls = plan_metadata(book_uids, library_uids)
+    lookups = fan_out(calls)
+    fill_metadata(books, libraries, calls, lookups)
 
-    return result
+    page["items"] = [reservation_view(reservation, books, libraries) for reservation in page["items"]]
+    return page
 
 # -------------------- Получение библиотек --------------------
 @app.route("/api/v1/libraries", methods=["GET"])
@@ -172,7 +981,10 @@ def get_libraries():
     page = request.args.get("page", 1)
     size = request.args.get("size", 1)
 
-    data = library_cb.call(fetch_libraries, city, page, size)
+    cursor = request.args.get("cursor")
+    count = request.args.get("count")
+
+    data = library_cb.call(fetch_libraries, city, page, size, cursor, count)
     return jsonify(data), 200 if "message" not in data else 503
 
 # -------------------- Получение книг --------------------
@@ -181,8 +993,10 @@ def get_books(library_uid):
     page = request.args.get("page", 1)
     size = request.args.get("size", 1)
     show_all = request.args.get("showAll", "false").lower() == "true"
+    cursor = request.args.get("cursor")
+    count = request.args.get("count")
 
-    data = library_cb.call(fetch_books, library_uid, page, size, show_all)
+    data = library_cb.call(fetch_books, library_uid, page, size, show_all, cursor, count)
     return jsonify(data), 200 if "message" not in data else 503
 
 
@@ -202,8 +1016,75 @@ def get_reservations():
     if not user_name:
         return jsonify({"error": "X-User-Name header is missing"}), 400
 
-    data = reservation_cb.call(fetch_reservations, user_name)
-    return jsonify(data), 200 if "message" not in data else 503
+    status = request.args.get("status")
+    if "size" in request.args or "cursor" in request.args:
+        # Одна страница: {"items", "pageSize", "nextCursor"}
+        size = request.args.get("size", default=RESERVATION_PAGE_SIZE, type=int)
+        page = reservation_cb.call(fetch_reservation_page, user_name, request.args.get("cursor"), size, status)
+        return jsonify(page), 200 if "message" not in page else 503
+
+    # Вся история - прежним JSON-массивом, но страница за страницей: в памяти не больше одной страницы.
+    # Первая страница запрашивается до ответа, чтобы недоступность сервиса осталась 503.
+    page = reservation_cb.call(fetch_reservation_page, user_name, None, RESERVATION_PAGE_SIZE, status)
+    if "message" in page:
+        return jsonify(page), 503
+    return Response(stream_with_context(stream_history(user_name, page, status)), mimetype="application/json")
+
+
+def stream_history(user_name, page, status):
+    yield "["
+    first = True
+    while True:
+        if page["items"]:
+            yield ("" if first else ",") + ",".join(json.dumps(item, ensure_ascii=False) for item in page["items"])
+            first = False
+        if page.get("nextCursor") is None:
+            break
+        page = reservation_cb.call(fetch_reservation_page, user_name, page["nextCursor"], RESERVATION_PAGE_SIZE, status)
+        if "message" in page:
+            # Статус 200 уже отправлен - обрываем ответ, чтобы клиент не принял часть истории за всю
+            raise RuntimeError(page["message"])
+    yield "]"
+
+
+# -------------------- Идемпотентные запросы --------------------
+def request_fingerprint(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def idempotent(scope, payload, handler):
+    # handler(operation_id) -> (body, status). С заголовком Idempotency-Key повтор запроса
+    # получает сохранённый ответ; без него запрос выполняется как обычно.
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return make_response(*handler(str(uuid4())))
+
+    outcome, value = saga_log.begin(scope, key, request_fingerprint(payload))
+    if outcome == "replay":
+        status_code, body = value
+        return Response(body, status=status_code, mimetype="application/json",
+                        headers={"Idempotent-Replayed": "true"})
+    if outcome == "busy":
+        return jsonify({"message": "Request with this Idempotency-Key is in progress"}), 409
+    if outcome == "mismatch":
+        return jsonify({"message": "Idempotency-Key was used with a different request"}), 422
+
+    try:
+        body, status = handler(value)
+    except Exception:
+        saga_log.release(scope, key)
+        raise
+    if status >= 500:
+        saga_log.release(scope, key)
+    else:
+        saga_log.complete(scope, key, status, json.dumps(body) if body is not None else "")
+    return make_response(body, status)
+
+
+def make_response(body, status):
+    if body is None:
+        return "", status
+    return jsonify(body), status
 
 
 # -------------------- Создание бронирования --------------------
@@ -214,73 +1095,88 @@ def create_reservation():
         return jsonify({"error": "X-User-Name header is missing"}), 400
 
     data = request.get_json()
+    return idempotent(f"{user_name}:reserve", data, lambda operation_id: reserve_book(user_name, data, operation_id))
+
+
+def reserve_book(user_name, data, operation_id):
+    # Сага: рейтинг и списание со склада -> бронь с проверкой лимита. Если бронь не создана,
+    # списание отменяется; все шаги идемпотентны по operation_id.
     book_uid = data.get("bookUid")
     library_uid = data.get("libraryUid")
     till_date = data.get("tillDate")
 
-    # Проверка лимита по количеству книг
-    rented_resp = requests.get(f"{RESERVATION_URL}/reservations/{user_name}/count")
-    rented_count = rented_resp.json().get("rentedCount", 0) if rented_resp.status_code == 200 else 0
+    # Рейтинг и списание не зависят друг от друга - запрашиваем параллельно.
+    # Списание сразу отдаёт книгу и библиотеку, отдельные запросы за метаданными не нужны.
+    lookups = fan_out({
+        "rating": (rating_cb, fetch_rating, user_name),
+        "stock": (library_cb, reserve_stock, library_uid, book_uid, operation_id),
+    })
+    stars_resp = lookups["rating"]
+    stock = lookups["stock"]
 
-    # Получаем рейтинг пользователя через Circuit Breaker
-    stars_resp = rating_cb.call(fetch_rating, user_name)
     if "message" in stars_resp:
-        return jsonify(stars_resp), 503
-
-    stars = stars_resp.get("stars", 1)
+        if "message" in stock or stock["available"]:
+            undo_stock(operation_id)
+        return stars_resp, 503
+    if "message" in stock:
+        # Исход неизвестен (например, таймаут) - отмена в фоне, для неприменённой операции она ничего не делает
+        saga_log.compensate(operation_id, "cancel")
+        return stock, 503
+    if not stock["available"]:
+        return {"message": "Book is not available"}, 409
 
-    if rented_count >= stars:
-        return jsonify({"message": "Maximum number of rented books reached"}), 400
+    book_data = stock.get("book", {})
+    library_data = stock.get("library", {})
+    if book_data:
+        book_cache.set(book_uid, book_data)
+    if library_data:
+        library_cache.set(library_uid, library_data)
 
-    # Получаем информацию о книге и библиотеке
-    book_resp = requests.get(f"{LIBRARY_URL}/libraries/{library_uid}/{book_uid}")
-    library_resp = requests.get(f"{LIBRARY_URL}/libraries/{library_uid}")
-    book_data = book_resp.json() if book_resp.status_code == 200 else {}
-    library_data = library_resp.json() if library_resp.status_code == 200 else {}
-
-    # Создаём запись в Reservation Service
-    payload = {"bookUid": book_uid, "libraryUid": library_uid, "tillDate": till_date}
-    headers = {"X-User-Name": user_name, "Content-Type": "application/json"}
+    # Создаём запись в Reservation Service; лимит по звёздам проверяется в той же транзакции
+    stars = stars_resp.get("stars", 1)
+    payload = {"bookUid": book_uid, "libraryUid": library_uid, "tillDate": till_date, "maxRented": stars}
+    headers = {"X-User-Name": user_name, "Content-Type": "application/json", "Idempotency-Key": operation_id}
 
     try:
-        res = requests.post(f"{RESERVATION_URL}/reservations", json=payload, headers=headers, timeout=3)
+        res = reservation_http.post(f"{RESERVATION_URL}/reservations", json=payload, headers=headers, timeout=HTTP_TIMEOUT)
+        if res.status_code == 409:
+            undo_stock(operation_id)
+            return {"message": "Maximum number of rented books reached"}, 400
         res.raise_for_status()
         reservation_json = res.json()
     except requests.RequestException:
-        return jsonify({"message": "Reservation Service unavailable"}), 503
-
-    try:
-        requests.patch(f"{LIBRARY_URL}/libraries/{library_uid}/books/{book_uid}/decrement", timeout=2)
-    except:
-        pass
+        # Компенсация: бронь не создана - возвращаем экземпляр на склад
+        undo_stock(operation_id)
+        return {"message": "Reservation Service unavailable"}, 503
 
     response = {
         "reservationUid": reservation_json.get("reservationUid"),
         "status": reservation_json.get("status", "RENTED"),
         "startDate": reservation_json.get("startDate"),
         "tillDate": till_date,
-        "book": {
-            "bookUid": book_uid,
-            "name": book_data.get("name", ""),
-            "author": book_data.get("author", ""),
-            "genre": book_data.get("genre", "")
-        },
-        "library": {
-            "libraryUid": library_uid,
-            "name": library_data.get("name", ""),
-            "address": library_data.get("address", ""),
-            "city": library_data.get("city", "")
-        },
+        "book": book_view(book_uid, book_data),
+        "library": library_view(library_uid, library_data),
         "rating": {"stars": stars}
     }
 
-    return jsonify(response), 200
+    return response, 200
+
+
+def undo_stock(operation_id):
+    # Отмена списания сразу; если library недоступен - через outbox в фоне
+    if "message" in library_cb.call(cancel_stock, operation_id):
+        saga_log.compensate(operation_id, "cancel")
 
 
 @app.route("/api/v1/reservations/<reservation_uid>/return", methods=["POST"])
 def return_book(reservation_uid):
     user_name = request.headers.get("X-User-Name")
     data = request.get_json()
+    return idempotent(f"{user_name}:return:{reservation_uid}", data,
+                      lambda operation_id: return_reservation(user_name, data, reservation_uid))
+
+
+def return_reservation(user_name, data, reservation_uid):
     returned_condition = data.get("condition")
     returned_date_str = data.get("date")
     returned_date = datetime.strptime(returned_date_str, "%Y-%m-%d").date()
@@ -289,50 +1185,309 @@ def return_book(reservation_uid):
 
     # Получаем reservation
     try:
-        resp = requests.get(f"{RESERVATION_URL}/reservations/{reservation_uid}/return", headers=headers)
+        resp = reservation_http.get(f"{RESERVATION_URL}/reservations/{reservation_uid}/return", headers=headers, timeout=HTTP_TIMEOUT)
         resp.raise_for_status()
         reservation = resp.json()
     except requests.RequestException:
-        return jsonify({"message": "Reservation Service unavailable"}), 503
+        return {"message": "Reservation Service unavailable"}, 503
 
     till_date = datetime.strptime(reservation["tillDate"], "%Y-%m-%d").date()
     status = "RETURNED"
     if returned_date > till_date:
         status = "EXPIRED"
 
-    # Обновляем Reservation Service
+    # Обновляем Reservation Service: 409 - бронь уже возвращена раньше
     try:
-        requests.post(f"{RESERVATION_URL}/reservations/{reservation_uid}/return",
-                      json={"condition": returned_condition, "date": returned_date_str},
-                      headers=headers)
-    except:
-        pass 
-    
-    # Обновляем рейтинг через Circuit Breaker
+        resp = reservation_http.post(f"{RESERVATION_URL}/reservations/{reservation_uid}/return",
+                                     json={"condition": returned_condition, "date": returned_date_str},
+                                     headers=headers, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        return {"message": "Reservation Service unavailable"}, 503
+    if resp.status_code >= 400 and resp.status_code != 409:
+        return {"message": "Reservation Service unavailable"}, 503
+    # 204 - возврат взятой книги; 200 - возврат просроченной: штраф уже начислил проход
+    # истечения, бонус не положен; 409 - повтор. Склад возвращаем во всех случаях
+    first_return = resp.status_code == 204
+
+    # Книга вернулась в библиотеку - увеличиваем available_count. operation_id привязан к брони,
+    # поэтому и после повторного возврата (например, после обрыва на этом шаге) склад изменится один раз
+    operation_id = f"return:{reservation['reservationUid']}"
+    library_uid, book_uid = reservation["libraryUid"], reservation["bookUid"]
+    if "message" in library_cb.call(release_stock, library_uid, book_uid, operation_id):
+        saga_log.compensate(operation_id, "increment", library_uid, book_uid)
+
+    # Обновляем рейтинг через Circuit Breaker; если сервис недоступен - ставим в очередь
+    if first_return:
+        rating_resp = rating_cb.call(apply_rating_delta, user_name, 1)
+        if "message" in rating_resp:
+            rating_queue.put(user_name, 1)
+
+    return None, 204
+
+# -------------------- Пакетное бронирование и возврат --------------------
+def batch_items(data, fields):
+    # -> (items, None) или (None, ошибка)
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, "items list required"
+    if len(items) > MAX_BATCH_ITEMS:
+        return None, f"At most {MAX_BATCH_ITEMS} items per request"
+    if not all(isinstance(item, dict) and all(item.get(field) for field in fields) for item in items):
+        return None, f"each item requires {', '.join(fields)}"
+    return items, None
+
+
+@app.route("/api/v1/reservations/batch", methods=["POST"])
+def create_reservations_batch():
+    user_name = request.headers.get("X-User-Name")
+    if not user_name:
+        return jsonify({"error": "X-User-Name header is missing"}), 400
+
+    data = request.get_json(silent=True)
+    items, error = batch_items(data, ("bookUid", "libraryUid", "tillDate"))
+    if error:
+        return jsonify({"message": error}), 400
+    return idempotent(f"{user_name}:reserve-batch", data,
+                      lambda operation_id: reserve_books(user_name, items, operation_id))
+
+
+def reserve_books(user_name, items, operation_id):
+    # Сага reserve_book на весь пакет: рейтинг и списание всех книг (одна транзакция
+    # library_service) параллельно, затем все брони одним запросом с проверкой лимита.
+    # Позиция пакета - отдельная операция склада "<operation_id>:<номер>".
+    operation_ids = [f"{operation_id}:{i}" for i in range(len(items))]
+    stock_items = [
+        {"libraryUid": item["libraryUid"], "bookUid": item["bookUid"], "operationId": item_operation_id}
+        for item, item_operation_id in zip(items, operation_ids)
+    ]
+    lookups = fan_out({
+        "rating": (rating_cb, fetch_rating, user_name),
+        "stock": (library_cb, reserve_stock_batch, stock_items),
+    })
+    stars_resp = lookups["rating"]
+    stock = lookups["stock"]
+
+    if "message" in stars_resp:
+        if "message" in stock or stock["available"]:
+            undo_stock_batch(operation_ids)
+        return stars_resp, 503
+    if "message" in stock:
+        for item_operation_id in operation_ids:
+            saga_log.compensate(item_operation_id, "cancel")
+        return stock, 503
+    if not stock["available"]:
+        return stock["reason"], stock["status"]
+
+    for item, reserved in zip(items, stock["items"]):
+        book_cache.set(item["bookUid"], reserved.get("book", {}))
+        library_cache.set(item["libraryUid"], reserved.get("library", {}))
+
+    stars = stars_resp.get("stars", 1)
+    payload = {
+        "items": [{"bookUid": item["bookUid"], "libraryUid": item["libraryUid"], "tillDate": item["tillDate"]}
+                  for item in items],
+        "maxRented": stars
+    }
+    headers = {"X-User-Name": user_name, "Content-Type": "application/json", "Idempotency-Key": operation_id}
     try:
-        stars_resp = rating_cb.call(fetch_rating, user_name)
-        if "message" in stars_resp:
-            # rating_service недоступен - пропускаем обновление рейтинга
-            stars_count = None
-        else:
-            stars_count = stars_resp.get("stars", 1)
-    except:
-        stars_count = None
+        res = reservation_http.post(f"{RESERVATION_URL}/reservations/batch", json=payload, headers=headers,
+                                    timeout=HTTP_TIMEOUT)
+        if res.status_code == 409:
+            undo_stock_batch(operation_ids)
+            return {"message": "Maximum number of rented books reached"}, 400
+        res.raise_for_status()
+        reservations = res.json()["items"]
+    except requests.RequestException:
+        undo_stock_batch(operation_ids)
+        return {"message": "Reservation Service unavailable"}, 503
+
+    return {
+        "items": [
+            {
+                "reservationUid": reservation.get("reservationUid"),
+                "status": reservation.get("status", "RENTED"),
+                "startDate": reservation.get("startDate"),
+                "tillDate": item["tillDate"],
+                "book": book_view(item["bookUid"], reserved.get("book", {})),
+                "library": library_view(item["libraryUid"], reserved.get("library", {}))
+            } for item, reserved, reservation in zip(items, stock["items"], reservations)
+        ],
+        "rating": {"stars": stars}
+    }, 200
+
+
+def undo_stock_batch(operation_ids):
+    # Отмены позиций параллельно; не выполненные сейчас - через outbox в фоне
+    results = fan_out({
+        item_operation_id: (library_cb, cancel_stock, item_operation_id) for item_operation_id in operation_ids
+    })
+    for item_operation_id, result in results.items():
+        if "message" in result:
+            saga_log.compensate(item_operation_id, "cancel")
+
+
+@app.route("/api/v1/reservations/return", methods=["POST"])
+def return_books():
+    user_name = request.headers.get("X-User-Name")
+    if not user_name:
+        return jsonify({"error": "X-User-Name header is missing"}), 400
+
+    data = request.get_json(silent=True)
+    items, error = batch_items(data, ("reservationUid",))
+    if error:
+        return jsonify({"message": error}), 400
+    return idempotent(f"{user_name}:return-batch", data,
+                      lambda operation_id: return_reservations(user_name, items))
+
+
+def return_reservations(user_name, items):
+    # Возврат пакета: брони - одним UPDATE, склад - одной транзакцией, рейтинг - одним
+    # изменением на число впервые возвращённых книг
+    reservation_uids = [item["reservationUid"] for item in items]
+    try:
+        resp = reservation_http.post(f"{RESERVATION_URL}/reservations/return/batch",
+                                     json={"reservationUids": reservation_uids},
+                                     headers={"X-User-Name": user_name}, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        return {"message": "Reservation Service unavailable"}, 503
+    if resp.status_code == 404:
+        return {"message": "Reservation not found", "reservationUids": resp.json().get("reservationUids", [])}, 404
+    if resp.status_code >= 400:
+        return {"message": "Reservation Service unavailable"}, 503
+    reservations = resp.json()["items"]
+
+    # operationId позиций - как у одиночного возврата: книга, уже возвращённая
+    # на склад (повтор, одиночный возврат раньше), второй раз не добавится
+    stock_items = [
+        {"libraryUid": r["libraryUid"], "bookUid": r["bookUid"], "operationId": f"return:{r['reservationUid']}"}
+        for r in reservations
+    ]
+    if "message" in library_cb.call(release_stock_batch, stock_items):
+        for item in stock_items:
+            saga_log.compensate(item["operationId"], "increment", item["libraryUid"], item["bookUid"])
+
+    # Бонус - только за взятые книги; просроченные уже оштрафованы проходом истечения
+    returned = sum(1 for r in reservations if r["returned"] and r["previousStatus"] == "RENTED")
+    if returned:
+        rating_resp = rating_cb.call(apply_rating_delta, user_name, returned)
+        if "message" in rating_resp:
+            rating_queue.put(user_name, returned)
+
+    return {"items": [
+        {"reservationUid": r["reservationUid"], "status": r["status"], "returned": r["returned"],
+         "previousStatus": r["previousStatus"]}
+        for r in reservations
+    ]}, 200
 
-    if stars_count is not None:
-        try:
-            requests.post(...)
-        except:
-            rating_queue.put({"user_name": user_name, "delta": 1})
-    else:
-        rating_queue.put({"user_name": user_name, "delta": 1})
 
+# -------------------- Circuit Breakers --------------------
+@app.route("/manage/circuit-breakers", methods=["GET"])
+def circuit_breaker_stats():
+    return jsonify([cb.stats() for cb in (library_cb, rating_cb, reservation_cb)]), 200
+
+# -------------------- Кэш --------------------
+@app.route("/manage/cache", methods=["GET"])
+def cache_stats():
+    return jsonify({"books": book_cache.stats(), "libraries": library_cache.stats()}), 200
+
+@app.route("/manage/cache", methods=["DELETE"])
+def cache_invalidate():
+    book_uid = request.args.get("bookUid")
+    library_uid = request.args.get("libraryUid")
+    if book_uid or library_uid:
+        if book_uid:
+            book_cache.invalidate(book_uid)
+        if library_uid:
+            library_cache.invalidate(library_uid)
+    else:
+        book_cache.invalidate()
+        library_cache.invalidate()
     return "", 204
 
+# -------------------- Метрики --------------------
+BREAKER_STATE_VALUES = {"CLOSED": 0, "HALF_OPEN": 1, "OPEN": 2}
+
+
+def gateway_collector(breakers):
+    # Состояние Circuit Breaker'ов, кэшей и outbox рейтинга; общий для app и async_app
+    def collect():
+        state = metrics.MetricFamily(
+            "circuit_breaker_state", "gauge", "Состояние breaker: 0 - CLOSED, 1 - HALF_OPEN, 2 - OPEN", merge="max"
+        )
+        transitions = metrics.MetricFamily("circuit_breaker_transitions_total", "counter", "Переходы breaker в состояние")
+        rejected = metrics.MetricFamily("circuit_breaker_rejected_total", "counter", "Вызовы, отклонённые breaker")
+        latency = metrics.MetricFamily("circuit_breaker_call_duration_seconds", "histogram", "Время вызовов через breaker")
+        for cb in breakers:
+            stats = cb.stats()
+            state.add(BREAKER_STATE_VALUES[stats["state"]], name=cb.name)
+            for to_state, count in stats["transitions"].items():
+                transitions.add(count, name=cb.name, state=to_state)
+            rejected.add(stats["rejected"], name=cb.name)
+            latency.histogram(
+                CircuitBreaker.LATENCY_BUCKETS, list(stats["latency"]["buckets"].values()),
+                stats["latency"]["sum"], name=cb.name
+            )
+
+        cache_requests = metrics.MetricFamily("cache_requests_total", "counter", "Обращения к кэшу метаданных")
+        cache_evictions = metrics.MetricFamily("cache_evictions_total", "counter", "Вытеснения из кэша")
+        cache_size = metrics.MetricFamily("cache_entries", "gauge", "Записей в локальном кэше")
+        for name, cache in (("books", book_cache), ("libraries", library_cache)):
+            stats = cache.stats()
+            cache_requests.add(stats["hits"], cache=name, result="hit")
+            cache_requests.add(stats["misses"], cache=name, result="miss")
+            cache_requests.add(stats["staleHits"], cache=name, result="stale")
+            cache_evictions.add(stats["evictions"], cache=name)
+            cache_size.add(stats["size"], cache=name)
+
+        families = [state, transitions, rejected, latency, cache_requests, cache_evictions, cache_size]
+        try:
+            outbox = rating_queue.stats()
+            stock_depth = saga_log.depth()
+        except sqlite3.Error:
+            return families
+        return families + [
+            # outbox общий для всех процессов gateway - глубину не суммируем
+            metrics.MetricFamily("rating_outbox_depth", "gauge", "Изменения рейтинга в очереди", merge="max")
+            .add(outbox["depth"]),
+            metrics.MetricFamily("rating_outbox_enqueued_total", "counter", "Изменения, поставленные в очередь")
+            .add(outbox["enqueued"]),
+            metrics.MetricFamily("rating_outbox_delivered_total", "counter", "Изменения, применённые в Rating Service")
+            .add(outbox["delivered"]),
+            metrics.MetricFamily("rating_outbox_retries_total", "counter", "Повторные попытки отправки")
+            .add(outbox["retried"]),
+            metrics.MetricFamily("stock_outbox_depth", "gauge", "Отложенные операции со складом", merge="max")
+            .add(stock_depth),
+            metrics.MetricFamily("stock_compensations_total", "counter", "Операции со складом, отложенные в outbox")
+            .add(saga_log.compensations),
+            metrics.MetricFamily("idempotent_replays_total", "counter", "Ответы, повторённые по Idempotency-Key")
+            .add(saga_log.replayed),
+        ]
+    return collect
+
+
+metrics_registry.register(gateway_collector((library_cb, rating_cb, reservation_cb)))
+
 # -------------------- Health --------------------
 @app.route("/manage/health", methods=["GET"])
 def health():
     return "OK", 200
 
+
+def check_ready(session, base_url):
+    resp = session.get(f"{base_url}/manage/health/ready", timeout=(HTTP_CONNECT_TIMEOUT, readiness.HEALTH_TIMEOUT))
+    resp.raise_for_status()
+
+
+# Gateway деградирует без соседних сервисов, но не работает без своих SQLite (outbox, saga):
+# недоступный сервис даёт DEGRADED, недоступная локальная база - DOWN
+readiness.init_flask(app, {
+    "library": lambda: check_ready(library_http, LIBRARY_URL),
+    "rating": lambda: check_ready(rating_http, RATING_URL),
+    "reservation": lambda: check_ready(reservation_http, RESERVATION_URL),
+    "ratingOutbox": rating_queue.depth,
+    "sagaLog": saga_log.depth,
+}, required=("ratingOutbox", "sagaLog"))
+
 if __name__ == "__main__":
+    start_background_workers()
     app.run(host="0.0.0.0", port=8080, debug=True)
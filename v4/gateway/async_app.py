@@ -0,0 +1,829 @@
+import asyncio
+import json
+import os
+import time
+from uuid import uuid4
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+from app import (
+    CircuitBreaker,
+    FANOUT_DEADLINE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_GET_RETRIES,
+    HTTP_POOL_SIZE,
+    HTTP_READ_TIMEOUT,
+    HTTP_RETRY_BACKOFF,
+    LIBRARY_URL,
+    RATING_BATCH_SIZE,
+    RATING_POLL_INTERVAL,
+    RATING_URL,
+    RESERVATION_PAGE_SIZE,
+    RESERVATION_URL,
+    batch_items,
+    book_cache,
+    book_view,
+    gateway_collector,
+    library_cache,
+    library_view,
+    rating_queue,
+    request_fingerprint,
+    reservation_uids,
+    reservation_view,
+    saga_log,
+    uid_chunks,
+)
+from common import metrics, readiness, tracing
+
+# Асинхронный режим gateway: те же маршруты /api/v1/*, но на event loop aiohttp
+# с неблокирующим HTTP-клиентом. Один процесс держит тысячи запросов в полёте
+# без потока на каждый запрос.
+#     python async_app.py
+#     GUNICORN_WORKER_CLASS=aiohttp.GunicornWebWorker gunicorn -c python:common.gunicorn_conf async_app:create_app
+
+
+class AsyncCircuitBreaker(CircuitBreaker):
+    # Та же статистика и те же состояния, что у CircuitBreaker: блокировка берётся только
+    # на обновление счётчиков и никогда не удерживается через await
+    async def call(self, func, *args, **kwargs):
+        permission = self._acquire()
+        if not permission:
+            return self.fallback(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            # Запрос не уложился в deadline - считаем как ошибку и освобождаем пробный слот
+            self._record(loop.time() - started, True, permission == "probe")
+            raise
+        except Exception:
+            self._record(loop.time() - started, True, permission == "probe")
+            return self.fallback(*args, **kwargs)
+
+        self._record(loop.time() - started, False, permission == "probe")
+        return result
+
+
+library_cb = AsyncCircuitBreaker("library", "Library Service unavailable")
+rating_cb = AsyncCircuitBreaker("rating", "Bonus Service unavailable")
+reservation_cb = AsyncCircuitBreaker("reservation", "Reservation Service unavailable")
+
+metrics_registry = metrics.Registry("gateway")
+request_metrics = metrics.RequestMetrics()
+metrics_registry.register(request_metrics.collect)
+metrics_registry.register(gateway_collector((library_cb, rating_cb, reservation_cb)))
+
+
+async def fan_out(calls, deadline=FANOUT_DEADLINE):
+    # calls: {имя: (circuit_breaker, coroutine_function, *args)} - как fan_out в app.py
+    tasks = {
+        name: asyncio.ensure_future(cb.call(func, *args))
+        for name, (cb, func, *args) in calls.items()
+    }
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=deadline)
+
+    results = {}
+    for name, task in tasks.items():
+        if task.done() and not task.cancelled():
+            results[name] = task.result()
+        else:
+            task.cancel()
+            results[name] = calls[name][0].fallback()
+    return results
+
+
+# -------------------- HTTP-клиенты --------------------
+class ServiceError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ServiceClient:
+    # Одна сессия с пулом keep-alive соединений на сервис.
+    # GET повторяется с backoff при ошибках соединения и 502/503/504, остальные методы - нет.
+    def __init__(self, service, base_url):
+        self.service = service
+        self.base_url = base_url
+        self.session = None
+
+    async def start(self):
+        self.session = ClientSession(
+            connector=TCPConnector(limit=HTTP_POOL_SIZE),
+            timeout=ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def request(self, method, path, params=None, **kwargs):
+        if isinstance(params, dict):
+            params = {key: str(value) for key, value in params.items() if value is not None}
+        retries = HTTP_GET_RETRIES if method == "GET" else 0
+
+        with tracing.span(f"{method} {path}", self.service) as span:
+            headers = tracing.inject(dict(kwargs.pop("headers", None) or {}))
+            for attempt in range(retries + 1):
+                try:
+                    async with self.session.request(
+                        method, self.base_url + path, params=params, headers=headers, **kwargs
+                    ) as resp:
+                        # 5xx - ошибка сервиса, как raise_for_status в app.py: тело не разбираем,
+                        # страница ошибки gunicorn/Flask - не JSON
+                        if resp.status >= 500:
+                            raise ServiceError(f"{method} {path}: {resp.status}", resp.status)
+                        try:
+                            data = await resp.json(content_type=None) if resp.status != 204 else None
+                        except ValueError:
+                            raise ServiceError(f"{method} {path}: invalid JSON response", resp.status)
+                        if span is not None:
+                            span.attributes.update(status=resp.status, attempts=attempt + 1)
+                        return resp.status, data
+                except (ClientError, asyncio.TimeoutError, ServiceError) as e:
+                    retriable = not isinstance(e, ServiceError) or e.status in (502, 503, 504)
+                    if attempt >= retries or not retriable:
+                        raise
+                await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** attempt)
+
+    async def get_json(self, path, params=None, **kwargs):
+        status, data = await self.request("GET", path, params=params, **kwargs)
+        if status >= 400:
+            raise ServiceError(f"GET {path}: {status}")
+        return data
+
+
+library_http = ServiceClient("library", LIBRARY_URL)
+rating_http = ServiceClient("rating", RATING_URL)
+reservation_http = ServiceClient("reservation", RESERVATION_URL)
+
+
+# -------------------- Вспомогательные функции для запросов --------------------
+async def fetch_libraries(city, page, size, cursor=None, count=None):
+    params = {"city": city, "page": page, "size": size, "cursor": cursor, "count": count}
+    return await library_http.get_json("/libraries", params=params)
+
+async def fetch_books(library_uid, page, size, show_all, cursor=None, count=None):
+    params = {"page": page, "size": size, "showAll": show_all, "cursor": cursor, "count": count}
+    return await library_http.get_json(f"/libraries/{library_uid}/books", params=params)
+
+async def fetch_rating(user_name):
+    return await rating_http.get_json("/rating", headers={"X-User-Name": user_name})
+
+async def apply_rating_delta(user_name, delta):
+    status, data = await rating_http.request(
+        "POST", "/rating/delta", json={"username": user_name, "delta": delta}
+    )
+    if status >= 400:
+        raise ServiceError(f"POST /rating/delta: {status}")
+    return data
+
+async def apply_rating_bulk(deltas):
+    updates = [{"username": user_name, "delta": delta} for user_name, delta in deltas.items()]
+    status, data = await rating_http.request("POST", "/rating/bulk", json={"updates": updates})
+    if status >= 400:
+        raise ServiceError(f"POST /rating/bulk: {status}")
+    return data
+
+async def reserve_stock(library_uid, book_uid, operation_id):
+    status, data = await library_http.request(
+        "POST", f"/libraries/{library_uid}/books/{book_uid}/reserve", headers={"X-Operation-Id": operation_id}
+    )
+    if status == 409:
+        return {"available": False}
+    if status >= 400:
+        raise ServiceError(f"POST reserve: {status}")
+    return {"available": True, **data}
+
+async def release_stock(library_uid, book_uid, operation_id):
+    status, data = await library_http.request(
+        "PATCH", f"/libraries/{library_uid}/books/{book_uid}/increment", headers={"X-Operation-Id": operation_id}
+    )
+    if status >= 400:
+        raise ServiceError(f"PATCH increment: {status}", status)
+    return data
+
+async def reserve_stock_batch(items):
+    status, data = await library_http.request("POST", "/stock/reserve", json={"items": items})
+    if status in (404, 409):
+        return {"available": False, "status": status, "reason": data}
+    if status >= 400:
+        raise ServiceError(f"POST /stock/reserve: {status}")
+    return {"available": True, **data}
+
+async def release_stock_batch(items):
+    status, data = await library_http.request("POST", "/stock/release", json={"items": items})
+    if status >= 400:
+        raise ServiceError(f"POST /stock/release: {status}", status)
+    return data
+
+async def cancel_stock(operation_id):
+    status, data = await library_http.request("POST", f"/stock-operations/{operation_id}/cancel")
+    if status >= 400:
+        raise ServiceError(f"POST cancel: {status}", status)
+    return data
+
+async def fetch_libraries_batch(library_uids):
+    # Пачки по LOOKUP_CHUNK_SIZE - параллельно
+    pages = await asyncio.gather(*(
+        library_http.get_json("/libraries/batch", params=[("libraryUid", uid) for uid in chunk])
+        for chunk in uid_chunks(library_uids)
+    ))
+    return {item["libraryUid"]: item for data in pages for item in data.get("items", [])}
+
+async def fetch_books_batch(book_uids):
+    pages = await asyncio.gather(*(
+        library_http.get_json("/books/batch", params=[("bookUid", uid) for uid in chunk])
+        for chunk in uid_chunks(book_uids)
+    ))
+    return {item["bookUid"]: item for data in pages for item in data.get("items", [])}
+
+async def cache_call(func, *args):
+    # Кэш в памяти отвечает сразу; с Redis-backend обращение уходит в поток, чтобы не блокировать loop
+    if book_cache.backend is None:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+async def plan_metadata(book_uids, library_uids):
+    books, missing_books = await cache_call(book_cache.get_many, book_uids)
+    libraries, missing_libraries = await cache_call(library_cache.get_many, library_uids)
+    calls = {}
+    if missing_books:
+        calls["books"] = (library_cb, fetch_books_batch, missing_books)
+    if missing_libraries:
+        calls["libraries"] = (library_cb, fetch_libraries_batch, missing_libraries)
+    return books, libraries, calls
+
+async def fill_metadata(books, libraries, calls, lookups):
+    if "books" in calls:
+        books.update(await cache_call(book_cache.fill, calls["books"][2], lookups["books"]))
+    if "libraries" in calls:
+        libraries.update(await cache_call(library_cache.fill, calls["libraries"][2], lookups["libraries"]))
+
+async def fetch_reservation_page(user_name, cursor, size, status=None):
+    params = {"cursor": cursor, "size": size, "status": status}
+    page = await reservation_http.get_json(f"/reservations/{user_name}", params=params)
+    book_uids, library_uids = reservation_uids(page["items"])
+
+    books, libraries, calls = await plan_metadata(book_uids, library_uids)
+    lookups = await fan_out(calls)
+    await fill_metadata(books, libraries, calls, lookups)
+
+    page["items"] = [reservation_view(reservation, books, libraries) for reservation in page["items"]]
+    return page
+
+
+def json_response(data, ok_status=200):
+    return web.json_response(data, status=ok_status if "message" not in data else 503)
+
+def missing_user():
+    return web.json_response({"error": "X-User-Name header is missing"}, status=400)
+
+
+# -------------------- Маршруты --------------------
+routes = web.RouteTableDef()
+
+
+@routes.get("/api/v1/libraries")
+async def get_libraries(request):
+    args = request.query
+    data = await library_cb.call(
+        fetch_libraries, args.get("city", "Москва"), args.get("page", 1), args.get("size", 1),
+        args.get("cursor"), args.get("count")
+    )
+    return json_response(data)
+
+
+@routes.get("/api/v1/libraries/{library_uid}/books")
+async def get_books(request):
+    args = request.query
+    show_all = args.get("showAll", "false").lower() == "true"
+    data = await library_cb.call(
+        fetch_books, request.match_info["library_uid"], args.get("page", 1), args.get("size", 1),
+        show_all, args.get("cursor"), args.get("count")
+    )
+    return json_response(data)
+
+
+@routes.get("/api/v1/rating")
+async def get_rating(request):
+    user_name = request.headers.get("X-User-Name")
+    if not user_name:
+        return missing_user()
+    return json_response(await rating_cb.call(fetch_rating, user_name))
+
+
+@routes.get("/api/v1/reservations")
+async def get_reservations(request):
+    user_name = request.headers.get("X-User-Name")
+    if not user_name:
+        return missing_user()
+
+    status = request.query.get("status")
+    if "size" in request.query or "cursor" in request.query:
+        size = request.query.get("size", "")
+        size = int(size) if size.isdigit() else RESERVATION_PAGE_SIZE
+        page = await reservation_cb.call(fetch_reservation_page, user_name, request.query.get("cursor"), size, status)
+        return json_response(page)
+
+    # Как в app.py: первая страница до ответа, остальные - потоком
+    page = await reservation_cb.call(fetch_reservation_page, user_name, None, RESERVATION_PAGE_SIZE, status)
+    if "message" in page:
+        return json_response(page)
+
+    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+    await response.prepare(request)
+    await response.write(b"[")
+    first = True
+    while True:
+        if page["items"]:
+            chunk = ",".join(json.dumps(item, ensure_ascii=False) for item in page["items"])
+            await response.write((chunk if first else "," + chunk).encode())
+            first = False
+        if page.get("nextCursor") is None:
+            break
+        page = await reservation_cb.call(fetch_reservation_page, user_name, page["nextCursor"], RESERVATION_PAGE_SIZE, status)
+        if "message" in page:
+            raise RuntimeError(page["message"])
+    await response.write(b"]")
+    await response.write_eof()
+    return response
+
+
+async def idempotent(request, scope, payload, handler):
+    # Как idempotent в app.py; операции SQLite - в потоке
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return make_response(*await handler(str(uuid4())))
+
+    outcome, value = await asyncio.to_thread(saga_log.begin, scope, key, request_fingerprint(payload))
+    if outcome == "replay":
+        status_code, body = value
+        return web.Response(text=body, status=status_code, content_type="application/json",
+                            headers={"Idempotent-Replayed": "true"})
+    if outcome == "busy":
+        return web.json_response({"message": "Request with this Idempotency-Key is in progress"}, status=409)
+    if outcome == "mismatch":
+        return web.json_response({"message": "Idempotency-Key was used with a different request"}, status=422)
+
+    try:
+        body, status = await handler(value)
+    except BaseException:
+        await asyncio.to_thread(saga_log.release, scope, key)
+        raise
+    if status >= 500:
+        await asyncio.to_thread(saga_log.release, scope, key)
+    else:
+        await asyncio.to_thread(saga_log.complete, scope, key, status, json.dumps(body) if body is not None else "")
+    return make_response(body, status)
+
+
+def make_response(body, status):
+    if body is None:
+        return web.Response(status=status)
+    return web.json_response(body, status=status)
+
+
+@routes.post("/api/v1/reservations")
+async def create_reservation(request):
+    user_name = request.headers.get("X-User-Name")
+    if not user_name:
+        return missing_user()
+
+    data = await request.json()
+    return await idempotent(
+        request, f"{user_name}:reserve", data, lambda operation_id: reserve_book(user_name, data, operation_id)
+    )
+
+
+async def reserve_book(user_name, data, operation_id):
+    book_uid = data.get("bookUid")
+    library_uid = data.get("libraryUid")
+    till_date = data.get("tillDate")
+
+    lookups = await fan_out({
+        "rating": (rating_cb, fetch_rating, user_name),
+        "stock": (library_cb, reserve_stock, library_uid, book_uid, operation_id),
+    })
+    stars_resp = lookups["rating"]
+    stock = lookups["stock"]
+
+    if "message" in stars_resp:
+        if "message" in stock or stock["available"]:
+            await undo_stock(operation_id)
+        return stars_resp, 503
+    if "message" in stock:
+        await asyncio.to_thread(saga_log.compensate, operation_id, "cancel")
+        return stock, 503
+    if not stock["available"]:
+        return {"message": "Book is not available"}, 409
+
+    book_data = stock.get("book", {})
+    library_data = stock.get("library", {})
+    if book_data:
+        await cache_call(book_cache.set, book_uid, book_data)
+    if library_data:
+        await cache_call(library_cache.set, library_uid, library_data)
+
+    stars = stars_resp.get("stars", 1)
+    payload = {"bookUid": book_uid, "libraryUid": library_uid, "tillDate": till_date, "maxRented": stars}
+    try:
+        status, reservation_json = await reservation_http.request(
+            "POST", "/reservations", json=payload,
+            headers={"X-User-Name": user_name, "Idempotency-Key": operation_id}
+        )
+        if status == 409:
+            await undo_stock(operation_id)
+            return {"message": "Maximum number of rented books reached"}, 400
+        if status >= 400:
+            raise ServiceError(f"POST /reservations: {status}")
+    except (ClientError, asyncio.TimeoutError, ServiceError):
+        await undo_stock(operation_id)
+        return {"message": "Reservation Service unavailable"}, 503
+
+    return {
+        "reservationUid": reservation_json.get("reservationUid"),
+        "status": reservation_json.get("status", "RENTED"),
+        "startDate": reservation_json.get("startDate"),
+        "tillDate": till_date,
+        "book": book_view(book_uid, book_data),
+        "library": library_view(library_uid, library_data),
+        "rating": {"stars": stars}
+    }, 200
+
+
+async def undo_stock(operation_id):
+    if "message" in await library_cb.call(cancel_stock, operation_id):
+        await asyncio.to_thread(saga_log.compensate, operation_id, "cancel")
+
+
+@routes.post("/api/v1/reservations/{reservation_uid}/return")
+async def return_book(request):
+    reservation_uid = request.match_info["reservation_uid"]
+    user_name = request.headers.get("X-User-Name")
+    data = await request.json()
+    return await idempotent(
+        request, f"{user_name}:return:{reservation_uid}", data,
+        lambda operation_id: return_reservation(user_name, data, reservation_uid)
+    )
+
+
+async def return_reservation(user_name, data, reservation_uid):
+    headers = {"X-User-Name": user_name}
+    try:
+        reservation = await reservation_http.get_json(f"/reservations/{reservation_uid}/return", headers=headers)
+        status, _ = await reservation_http.request(
+            "POST", f"/reservations/{reservation_uid}/return",
+            json={"condition": data.get("condition"), "date": data.get("date")}, headers=headers
+        )
+    except (ClientError, asyncio.TimeoutError, ServiceError):
+        return {"message": "Reservation Service unavailable"}, 503
+    if status >= 400 and status != 409:
+        return {"message": "Reservation Service unavailable"}, 503
+
+    operation_id = f"return:{reservation['reservationUid']}"
+    library_uid, book_uid = reservation["libraryUid"], reservation["bookUid"]
+    if "message" in await library_cb.call(release_stock, library_uid, book_uid, operation_id):
+        await asyncio.to_thread(saga_log.compensate, operation_id, "increment", library_uid, book_uid)
+
+    if status == 204:
+        rating_resp = await rating_cb.call(apply_rating_delta, user_name, 1)
+        if "message" in rating_resp:
+            await asyncio.to_thread(rating_queue.put, user_name, 1)
+
+    return None, 204
+
+
+@routes.post("/api/v1/reservations/batch")
+async def create_reservations_batch(request):
+    user_name = request.headers.get("X-User-Name")
+    if not user_name:
+        return missing_user()
+
+    data = await request.json()
+    items, error = batch_items(data, ("bookUid", "libraryUid", "tillDate"))
+    if error:
+        return web.json_response({"message": error}, status=400)
+    return await idempotent(
+        request, f"{user_name}:reserve-batch", data, lambda operation_id: reserve_books(user_name, items, operation_id)
+    )
+
+
+async def reserve_books(user_name, items, operation_id):
+    operation_ids = [f"{operation_id}:{i}" for i in range(len(items))]
+    stock_items = [
+        {"libraryUid": item["libraryUid"], "bookUid": item["bookUid"], "operationId": item_operation_id}
+        for item, item_operation_id in zip(items, operation_ids)
+    ]
+    lookups = await fan_out({
+        "rating": (rating_cb, fetch_rating, user_name),
+        "stock": (library_cb, reserve_stock_batch, stock_items),
+    })
+    stars_resp = lookups["rating"]
+    stock = lookups["stock"]
+
+    if "message" in stars_resp:
+        if "message" in stock or stock["available"]:
+            await undo_stock_batch(operation_ids)
+        return stars_resp, 503
+    if "message" in stock:
+        for item_operation_id in operation_ids:
+            await asyncio.to_thread(saga_log.compensate, item_operation_id, "cancel")
+        return stock, 503
+    if not stock["available"]:
+        return stock["reason"], stock["status"]
+
+    for item, reserved in zip(items, stock["items"]):
+        await cache_call(book_cache.set, item["bookUid"], reserved.get("book", {}))
+        await cache_call(library_cache.set, item["libraryUid"], reserved.get("library", {}))
+
+    stars = stars_resp.get("stars", 1)
+    payload = {
+        "items": [{"bookUid": item["bookUid"], "libraryUid": item["libraryUid"], "tillDate": item["tillDate"]}
+                  for item in items],
+        "maxRented": stars
+    }
+    try:
+        status, data = await reservation_http.request(
+            "POST", "/reservations/batch", json=payload,
+            headers={"X-User-Name": user_name, "Idempotency-Key": operation_id}
+        )
+        if status == 409:
+            await undo_stock_batch(operation_ids)
+            return {"message": "Maximum number of rented books reached"}, 400
+        if status >= 400:
+            raise ServiceError(f"POST /reservations/batch: {status}")
+    except (ClientError, asyncio.TimeoutError, ServiceError):
+        await undo_stock_batch(operation_ids)
+        return {"message": "Reservation Service unavailable"}, 503
+
+    return {
+        "items": [
+            {
+                "reservationUid": reservation.get("reservationUid"),
+                "status": reservation.get("status", "RENTED"),
+                "startDate": reservation.get("startDate"),
+                "tillDate": item["tillDate"],
+                "book": book_view(item["bookUid"], reserved.get("book", {})),
+                "library": library_view(item["libraryUid"], reserved.get("library", {}))
+            } for item, reserved, reservation in zip(items, stock["items"], data["items"])
+        ],
+        "rating": {"stars": stars}
+    }, 200
+
+
+async def undo_stock_batch(operation_ids):
+    await asyncio.gather(*(undo_stock(item_operation_id) for item_operation_id in operation_ids))
+
+
+@routes.post("/api/v1/reservations/return")
+async def return_books(request):
+    user_name = request.headers.get("X-User-Name")
+    if not user_name:
+        return missing_user()
+
+    data = await request.json()
+    items, error = batch_items(data, ("reservationUid",))
+    if error:
+        return web.json_response({"message": error}, status=400)
+    return await idempotent(
+        request, f"{user_name}:return-batch", data, lambda operation_id: return_reservations(user_name, items)
+    )
+
+
+async def return_reservations(user_name, items):
+    reservation_uids = [item["reservationUid"] for item in items]
+    try:
+        status, data = await reservation_http.request(
+            "POST", "/reservations/return/batch", json={"reservationUids": reservation_uids},
+            headers={"X-User-Name": user_name}
+        )
+    except (ClientError, asyncio.TimeoutError, ServiceError):
+        return {"message": "Reservation Service unavailable"}, 503
+    if status == 404:
+        return {"message": "Reservation not found", "reservationUids": data.get("reservationUids", [])}, 404
+    if status >= 400:
+        return {"message": "Reservation Service unavailable"}, 503
+    reservations = data["items"]
+
+    stock_items = [
+        {"libraryUid": r["libraryUid"], "bookUid": r["bookUid"], "operationId": f"return:{r['reservationUid']}"}
+        for r in reservations
+    ]
+    if "message" in await library_cb.call(release_stock_batch, stock_items):
+        for item in stock_items:
+            await asyncio.to_thread(
+                saga_log.compensate, item["operationId"], "increment", item["libraryUid"], item["bookUid"]
+            )
+
+    # Бонус - только за взятые книги; просроченные уже оштрафованы проходом истечения
+    returned = sum(1 for r in reservations if r["returned"] and r["previousStatus"] == "RENTED")
+    if returned:
+        rating_resp = await rating_cb.call(apply_rating_delta, user_name, returned)
+        if "message" in rating_resp:
+            await asyncio.to_thread(rating_queue.put, user_name, returned)
+
+    return {"items": [
+        {"reservationUid": r["reservationUid"], "status": r["status"], "returned": r["returned"],
+         "previousStatus": r["previousStatus"]}
+        for r in reservations
+    ]}, 200
+
+
+@routes.get("/manage/circuit-breakers")
+async def circuit_breaker_stats(request):
+    return web.json_response([cb.stats() for cb in (library_cb, rating_cb, reservation_cb)])
+
+
+@routes.get("/manage/cache")
+async def cache_stats(request):
+    return web.json_response({"books": book_cache.stats(), "libraries": library_cache.stats()})
+
+
+@routes.delete("/manage/cache")
+async def cache_invalidate(request):
+    book_uid = request.query.get("bookUid")
+    library_uid = request.query.get("libraryUid")
+    if book_uid or library_uid:
+        if book_uid:
+            await cache_call(book_cache.invalidate, book_uid)
+        if library_uid:
+            await cache_call(library_cache.invalidate, library_uid)
+    else:
+        await cache_call(book_cache.invalidate)
+        await cache_call(library_cache.invalidate)
+    return web.Response(status=204)
+
+
+@routes.get("/manage/traces")
+async def recent_traces(request):
+    limit = int(request.query.get("limit", 50))
+    return web.json_response(tracing.exporter.traces(limit, request.query.get("traceId")))
+
+
+@routes.get("/manage/metrics")
+async def prometheus_metrics(request):
+    # Глубина outbox читается из SQLite - не в event loop
+    body = await asyncio.to_thread(metrics_registry.render)
+    return web.Response(body=body.encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+@routes.get("/manage/health")
+async def health(request):
+    return web.Response(text="OK")
+
+
+async def timed_check(check):
+    # Аналог readiness.timed_check для корутин, бюджет - тот же HEALTH_TIMEOUT
+    started = asyncio.get_running_loop().time()
+    try:
+        await asyncio.wait_for(check(), readiness.HEALTH_TIMEOUT)
+        result = {"status": "UP"}
+    except asyncio.TimeoutError:
+        result = {"status": "DOWN", "error": f"timeout after {readiness.HEALTH_TIMEOUT}s"}
+    except Exception as e:
+        result = {"status": "DOWN", "error": f"{type(e).__name__}: {e}"[:200]}
+    result["elapsedMs"] = round((asyncio.get_running_loop().time() - started) * 1000, 1)
+    return result
+
+
+async def check_ready(client):
+    status, _ = await client.request("GET", "/manage/health/ready")
+    if status >= 400:
+        raise ServiceError(f"ready: {status}")
+
+
+@routes.get("/manage/health/ready")
+async def ready(request):
+    checks = {
+        "library": lambda: check_ready(library_http),
+        "rating": lambda: check_ready(rating_http),
+        "reservation": lambda: check_ready(reservation_http),
+        "ratingOutbox": lambda: asyncio.to_thread(rating_queue.depth),
+        "sagaLog": lambda: asyncio.to_thread(saga_log.depth),
+    }
+    results = await asyncio.gather(*(timed_check(check) for check in checks.values()))
+    body, status = readiness.summarize(dict(zip(checks, results)), required=("ratingOutbox", "sagaLog"))
+    return web.json_response(body, status=status)
+
+
+@web.middleware
+async def trace_middleware(request, handler):
+    # Аналог tracing.init_flask: спан на входящий запрос и заголовок Server-Timing
+    resource = request.match_info.route.resource
+    name = f"{request.method} {resource.canonical if resource is not None else request.path}"
+    span, token = tracing.start_request("gateway", name, request.headers.get("traceparent"))
+    try:
+        response = await handler(request)
+        span.attributes["status"] = response.status
+        if not response.prepared:
+            # У потокового ответа заголовки уже отправлены
+            response.headers["Server-Timing"] = tracing.server_timing(span)
+        return response
+    except Exception as e:
+        span.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        tracing.finish_request(span, token)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        request_metrics.observe(request.method, route, status, time.perf_counter() - started)
+
+
+# -------------------- Очередь обновлений рейтинга --------------------
+async def rating_queue_worker():
+    # Асинхронный аналог rating_queue_worker: тот же outbox, операции SQLite - в потоке
+    while True:
+        try:
+            rows = await asyncio.to_thread(rating_queue.claim, RATING_BATCH_SIZE)
+        except Exception:
+            rows = []
+        if not rows:
+            await asyncio.sleep(RATING_POLL_INTERVAL)
+            continue
+
+        deltas = {}
+        for _, user_name, delta, _ in rows:
+            deltas[user_name] = deltas.get(user_name, 0) + delta
+
+        try:
+            await apply_rating_bulk(deltas)
+        except Exception:
+            await asyncio.to_thread(rating_queue.retry, rows)
+            continue
+
+        await asyncio.to_thread(rating_queue.ack, rows)
+
+
+async def stock_outbox_worker():
+    # Асинхронный аналог stock_outbox_worker из app.py
+    while True:
+        try:
+            rows = await asyncio.to_thread(saga_log.claim, RATING_BATCH_SIZE)
+        except Exception:
+            await asyncio.sleep(RATING_POLL_INTERVAL)
+            continue
+
+        if not rows:
+            await asyncio.sleep(RATING_POLL_INTERVAL)
+            continue
+
+        done, failed = [], []
+        for row in rows:
+            operation_id, action, library_uid, book_uid, _ = row
+            try:
+                if action == "cancel":
+                    await cancel_stock(operation_id)
+                else:
+                    await release_stock(library_uid, book_uid, operation_id)
+                done.append(row)
+            except ServiceError as e:
+                (done if e.status is not None and e.status < 500 else failed).append(row)
+            except (ClientError, asyncio.TimeoutError):
+                failed.append(row)
+        await asyncio.to_thread(saga_log.ack, done)
+        await asyncio.to_thread(saga_log.retry, failed)
+
+
+async def on_startup(app):
+    for client in (library_http, rating_http, reservation_http):
+        await client.start()
+    app["rating_worker"] = asyncio.ensure_future(rating_queue_worker())
+    app["stock_worker"] = asyncio.ensure_future(stock_outbox_worker())
+    metrics_registry.start_flusher()
+
+
+async def on_cleanup(app):
+    app["rating_worker"].cancel()
+    app["stock_worker"].cancel()
+    for client in (library_http, rating_http, reservation_http):
+        await client.close()
+
+
+async def create_app():
+    app = web.Application(middlewares=[metrics_middleware, trace_middleware])
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,97 @@
+import importlib.util
+import os
+import sys
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+V4_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, V4_DIR)
+
+
+def load_service(name, database_url=None, **env):
+    # Каждый сервис - отдельный app.py; загружаем под уникальным именем модуля,
+    # база - SQLite во временном каталоге, миграции выполняются при импорте
+    # env - переменные окружения только на время импорта (настройки читаются в константы модуля)
+    if database_url:
+        env["DATABASE_URL"] = database_url
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(V4_DIR, name, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return module
+
+
+class ServiceResponse:
+    def __init__(self, resp):
+        self.status_code = resp.status_code
+        self.content = resp.data
+        self._resp = resp
+
+    def json(self):
+        return self._resp.get_json()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}", response=self)
+
+
+class ServiceTransport:
+    # Замена requests.Session gateway: запросы к сервису уходят в его Flask test client.
+    # down = True - сервис недоступен (ConnectionError, как при отказе соединения)
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.down = False
+        self.calls = []
+
+    def request(self, method, url, params=None, json=None, headers=None, timeout=None):
+        path = urlsplit(url).path
+        self.calls.append((method, path))
+        if self.down:
+            raise requests.ConnectionError(f"{method} {path}: connection refused")
+        return ServiceResponse(self.client.open(path, method=method, query_string=params, json=json,
+                                                headers=headers))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+
+@pytest.fixture
+def rating(tmp_path):
+    return load_service("rating", f"sqlite:///{tmp_path / 'rating.db'}")
+
+
+@pytest.fixture
+def library(tmp_path):
+    return load_service("library", f"sqlite:///{tmp_path / 'library.db'}")
+
+
+@pytest.fixture
+def reservation(tmp_path):
+    # Фоновый проход истечения выключен - тесты вызывают sweep() сами
+    return load_service("reservation", f"sqlite:///{tmp_path / 'reservation.db'}", EXPIRY_SWEEP_INTERVAL="0")
+
+
+@pytest.fixture
+def gateway(tmp_path):
+    # Outbox рейтинга и журнал саг - SQLite-файлы во временном каталоге; фоновые потоки не запускаются
+    return load_service(
+        "gateway",
+        RATING_OUTBOX_PATH=str(tmp_path / "rating_outbox.db"),
+        IDEMPOTENCY_PATH=str(tmp_path / "idempotency.db"),
+    )
@@ -0,0 +1,35 @@
+import threading
+import time
+
+
+def test_fan_out_records_deadline_miss_once(gateway):
+    cb = gateway.CircuitBreaker("test", "Test Service unavailable")
+    finished = threading.Event()
+
+    def slow():
+        time.sleep(0.3)
+        finished.set()
+        return {"ok": True}
+
+    results = gateway.fan_out({"slow": (cb, slow), "fast": (cb, lambda: {"ok": True})}, deadline=0.05)
+
+    assert results == {"slow": {"message": "Test Service unavailable"}, "fast": {"ok": True}}
+    assert cb.stats()["window"] == {"calls": 2, "failures": 1, "slow": 0}
+    # Поздний ответ уже засчитанного отказа статистику не меняет
+    assert finished.wait(2)
+    time.sleep(0.05)
+    assert cb.stats()["window"]["calls"] == 2
+
+
+def test_abandoned_probe_reopens_breaker(gateway):
+    cb = gateway.CircuitBreaker("test", "Test Service unavailable", minimum_calls=1, retry_timeout=0)
+    cb.call(lambda: 1 / 0)
+    assert cb.state == "OPEN"
+
+    release = threading.Event()
+    results = gateway.fan_out({"probe": (cb, release.wait, 2)}, deadline=0.05)
+    release.set()
+
+    assert results == {"probe": {"message": "Test Service unavailable"}}
+    assert cb.state == "OPEN"
+    assert cb.half_open_calls == 0
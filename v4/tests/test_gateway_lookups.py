@@ -0,0 +1,46 @@
+from uuid import uuid4
+
+
+class FakeResponse:
+    def __init__(self, items):
+        self.items = items
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"items": self.items}
+
+
+class FakeLibrary:
+    # library_service: отвечает на /books/batch и /libraries/batch, запоминает число UID в запросе
+    def __init__(self, field):
+        self.field = field
+        self.sizes = []
+
+    def get(self, url, params, timeout):
+        uids = params[self.field]
+        self.sizes.append(len(uids))
+        return FakeResponse([{self.field: uid} for uid in uids])
+
+
+def test_book_lookups_are_chunked(gateway, monkeypatch):
+    library = FakeLibrary("bookUid")
+    monkeypatch.setattr(gateway, "library_http", library)
+    book_uids = [str(uuid4()) for _ in range(gateway.RESERVATION_PAGE_SIZE)]
+
+    books = gateway.fetch_books_batch(book_uids)
+
+    assert set(books) == set(book_uids)
+    assert max(library.sizes) <= gateway.LOOKUP_CHUNK_SIZE
+    assert sum(library.sizes) == len(book_uids)
+
+
+def test_library_lookups_are_chunked(gateway, monkeypatch):
+    library = FakeLibrary("libraryUid")
+    monkeypatch.setattr(gateway, "library_http", library)
+    library_uids = [str(uuid4()) for _ in range(gateway.LOOKUP_CHUNK_SIZE + 1)]
+
+    assert set(gateway.fetch_libraries_batch(library_uids)) == set(library_uids)
+    assert library.sizes == [gateway.LOOKUP_CHUNK_SIZE, 1]
+    assert gateway.fetch_libraries_batch([]) == {}
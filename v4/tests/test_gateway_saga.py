@@ -0,0 +1,152 @@
+import os
+from uuid import uuid4
+
+import pytest
+
+from conftest import ServiceTransport
+
+LIBRARY_UID = "83575e12-7ce0-48ee-9931-51919ff3c9ee"
+BOOK_UID = "f7cdc58f-2caf-4b15-9727-f89dcc629b27"
+USER = {"X-User-Name": "Test Max"}
+
+
+@pytest.fixture
+def services(gateway, library, reservation, rating, monkeypatch):
+    # Gateway ходит в сервисы через их test client; фоновые потоки gateway не запускаются,
+    # outbox компенсаций разбирается в тесте явно
+    transports = {
+        "library": ServiceTransport(library.app),
+        "reservation": ServiceTransport(reservation.app),
+        "rating": ServiceTransport(rating.app),
+    }
+    for name, transport in transports.items():
+        monkeypatch.setattr(gateway, f"{name}_http", transport)
+    monkeypatch.setattr(gateway, "_background_pid", os.getpid())
+    return transports
+
+
+def available(library):
+    resp = library.app.test_client().get(f"/libraries/{LIBRARY_UID}/books?showAll=true")
+    return resp.get_json()["items"][0]["availableCount"]
+
+
+def reserve(gateway, **headers):
+    return gateway.app.test_client().post("/api/v1/reservations", headers={**USER, **headers}, json={
+        "bookUid": BOOK_UID, "libraryUid": LIBRARY_UID, "tillDate": "2030-01-01"
+    })
+
+
+def test_reservation_failure_restores_stock(gateway, library, services):
+    services["reservation"].down = True
+
+    resp = reserve(gateway)
+
+    assert resp.status_code == 503
+    assert ("POST", f"/libraries/{LIBRARY_UID}/books/{BOOK_UID}/reserve") in services["library"].calls
+    assert available(library) == 1
+    assert gateway.saga_log.depth() == 0
+
+
+def test_rented_limit_restores_stock(gateway, library, rating, services):
+    with rating.app.app_context():
+        rating.apply_deltas({"Test Max": -1})
+        rating.db.session.commit()
+
+    resp = reserve(gateway)
+
+    assert resp.status_code == 400
+    assert available(library) == 1
+
+
+def test_unfinished_compensation_goes_through_outbox(gateway, library, services, monkeypatch):
+    # Бронь не создана, отменить списание сразу нельзя - library недоступен
+    services["reservation"].down = True
+    original = gateway.cancel_stock
+
+    def cancel_while_down(operation_id):
+        services["library"].down = True
+        return original(operation_id)
+
+    monkeypatch.setattr(gateway, "cancel_stock", cancel_while_down)
+    assert reserve(gateway).status_code == 503
+    assert available(library) == 0
+    assert gateway.saga_log.depth() == 1
+
+    # Один проход stock_outbox_worker после восстановления library
+    monkeypatch.setattr(gateway, "cancel_stock", original)
+    services["library"].down = False
+    rows = gateway.saga_log.claim(10)
+    for row in rows:
+        gateway.run_stock_action(*row[:4])
+    gateway.saga_log.ack(rows)
+    assert available(library) == 1
+    assert gateway.saga_log.depth() == 0
+
+
+def test_idempotent_reservation_replays_response(gateway, library, services):
+    key = str(uuid4())
+    first = reserve(gateway, **{"Idempotency-Key": key})
+    second = reserve(gateway, **{"Idempotency-Key": key})
+
+    assert first.status_code == second.status_code == 200
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.get_json() == first.get_json()
+    assert available(library) == 0
+
+
+def test_operation_id_replay_decrements_once(library):
+    client = library.app.test_client()
+    headers = {"X-Operation-Id": str(uuid4())}
+    path = f"/libraries/{LIBRARY_UID}/books/{BOOK_UID}"
+
+    first = client.post(f"{path}/reserve", headers=headers)
+    second = client.post(f"{path}/reserve", headers=headers)
+    third = client.patch(f"{path}/decrement", headers=headers)
+
+    assert first.status_code == second.status_code == third.status_code == 200
+    assert first.get_json()["availableCount"] == second.get_json()["availableCount"] == 0
+    assert available(library) == 0
+
+    # Отмена возвращает экземпляр один раз, сколько бы раз её ни повторили
+    for _ in range(2):
+        assert client.post(f"/stock-operations/{headers['X-Operation-Id']}/cancel").status_code == 200
+    assert available(library) == 1
+
+
+def test_cancel_unknown_operation_blocks_late_request(library):
+    client = library.app.test_client()
+    operation_id = str(uuid4())
+
+    resp = client.post(f"/stock-operations/{operation_id}/cancel")
+    assert resp.status_code == 200
+    assert resp.get_json() == {"operationId": operation_id, "cancelled": True}
+
+    # Запрос, отменённый до того, как дошёл до library, склад уже не меняет
+    resp = client.post(f"/libraries/{LIBRARY_UID}/books/{BOOK_UID}/reserve", headers={"X-Operation-Id": operation_id})
+    assert resp.status_code == 409
+    assert available(library) == 1
+
+
+def test_batch_reservation_failure_restores_all_items(gateway, library, services):
+    second_book = str(uuid4())
+    library.app.test_client().post("/catalogue/import", json={
+        "libraryUid": LIBRARY_UID, "libraryName": "Библиотека имени 7 Непьющих", "city": "Москва",
+        "address": "2-я Бауманская ул., д.5, стр.1", "bookUid": second_book, "name": "Второй том", "availableCount": 2
+    })
+    items = [
+        {"bookUid": book_uid, "libraryUid": LIBRARY_UID, "tillDate": "2030-01-01"}
+        for book_uid in (BOOK_UID, second_book)
+    ]
+    client = gateway.app.test_client()
+
+    services["reservation"].down = True
+    assert client.post("/api/v1/reservations/batch", headers=USER, json={"items": items}).status_code == 503
+    # Пакет целиком: книги BOOK_UID одна, второй экземпляр её не найдётся
+    services["reservation"].down = False
+    resp = client.post("/api/v1/reservations/batch", headers=USER, json={"items": items + items[:1]})
+    assert resp.status_code == 409
+
+    listing = library.app.test_client().get(f"/libraries/{LIBRARY_UID}/books?showAll=true&size=10").get_json()
+    counts = {item["bookUid"]: item["availableCount"] for item in listing["items"]}
+    assert counts == {BOOK_UID: 1, second_book: 2}
+    assert gateway.saga_log.depth() == 0
@@ -0,0 +1,37 @@
+import pytest
+
+from conftest import load_service
+
+
+@pytest.mark.parametrize("fmt, mimetype", [("ndjson", "application/x-ndjson"), ("csv", "text/csv")])
+def test_export_import_round_trip(library, tmp_path, fmt, mimetype):
+    client = library.app.test_client()
+    # К тестовым данным: библиотека без книг и книга без библиотеки
+    resp = client.post("/catalogue/import", data=(
+        '{"libraryUid": "5b2fd9c6-7e5e-4d4b-9a3c-0c1d2e3f4a5b", "libraryName": "Пустая", '
+        '"city": "Казань", "address": "ул. Баумана, 1"}\n'
+        '{"bookUid": "9d6a8f0e-1c2b-4a3d-8e7f-6a5b4c3d2e1f", "name": "Без библиотеки", "author": "Автор"}\n'
+    ), content_type="application/x-ndjson")
+    assert resp.get_json()["rejected"] == 0
+
+    exported = client.get(f"/catalogue/export?format={fmt}").get_data(as_text=True)
+    assert "5b2fd9c6-7e5e-4d4b-9a3c-0c1d2e3f4a5b" in exported
+    assert "9d6a8f0e-1c2b-4a3d-8e7f-6a5b4c3d2e1f" in exported
+
+    other = load_service("library", f"sqlite:///{tmp_path / 'other.db'}")
+    other_client = other.app.test_client()
+    resp = other_client.post("/catalogue/import", data=exported, content_type=mimetype)
+    assert resp.get_json()["rejected"] == 0
+    assert other_client.get(f"/catalogue/export?format={fmt}").get_data(as_text=True) == exported
+
+
+def test_export_single_library_without_books(library):
+    client = library.app.test_client()
+    client.post("/catalogue/import", data=(
+        '{"libraryUid": "5b2fd9c6-7e5e-4d4b-9a3c-0c1d2e3f4a5b", "libraryName": "Пустая", '
+        '"city": "Казань", "address": "ул. Баумана, 1"}\n'
+    ), content_type="application/x-ndjson")
+
+    lines = client.get("/catalogue/export?libraryUid=5b2fd9c6-7e5e-4d4b-9a3c-0c1d2e3f4a5b").get_data(as_text=True)
+    assert lines.count("\n") == 1
+    assert '"bookUid": null' in lines
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+LIBRARY_UID = "83575e12-7ce0-48ee-9931-51919ff3c9ee"
+
+
+@contextmanager
+def count_statements(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def add_books(library, count):
+    with library.app.app_context():
+        db = library.db
+        for i in range(count):
+            book = library.Book(name=f"Book {i}", author="Author", genre="Genre", condition="GOOD")
+            db.session.add(book)
+            db.session.flush()
+            db.session.add(library.LibraryBook(book_id=book.id, library_id=1, available_count=i % 3))
+        db.session.commit()
+
+
+def test_book_listing_query_count_does_not_grow_with_page(library):
+    add_books(library, 30)
+    client = library.app.test_client()
+    with library.app.app_context():
+        engine = library.db.engine
+
+    counts = {}
+    for size in (1, 25):
+        with count_statements(engine) as statements:
+            resp = client.get(f"/libraries/{LIBRARY_UID}/books?showAll=true&size={size}")
+        assert resp.status_code == 200
+        assert len(resp.get_json()["items"]) == size
+        counts[size] = len(statements)
+
+    # Страница с книгами и totalElements - одним запросом, без запроса на каждую книгу
+    assert counts == {1: 1, 25: 1}
+
+
+def test_empty_book_listing_checks_library_once(library):
+    client = library.app.test_client()
+    with library.app.app_context():
+        engine = library.db.engine
+
+    with count_statements(engine) as statements:
+        resp = client.get("/libraries/00000000-0000-0000-0000-000000000000/books")
+    assert resp.status_code == 404
+    assert len(statements) == 2
+
+
+def test_batch_lookup_rejects_too_many_uids(library):
+    client = library.app.test_client()
+    uids = "&".join(f"bookUid=book-{i}" for i in range(library.MAX_LOOKUP_ITEMS + 1))
+    resp = client.get(f"/books/batch?{uids}")
+    assert resp.status_code == 400
+
+    resp = client.get("/books/batch?bookUid=f7cdc58f-2caf-4b15-9727-f89dcc629b27")
+    assert [item["bookUid"] for item in resp.get_json()["items"]] == ["f7cdc58f-2caf-4b15-9727-f89dcc629b27"]
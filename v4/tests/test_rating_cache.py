@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+
+def stored_stars(rating, username):
+    with rating.app.app_context():
+        row = rating.db.session.execute(
+            rating.select(rating.Rating.stars).where(rating.Rating.username == username)
+        ).scalar()
+        rating.db.session.rollback()
+        return row
+
+
+@pytest.mark.parametrize("ttl", [0, 60])
+def test_concurrent_add_and_lookup_during_flush(rating, monkeypatch, ttl):
+    monkeypatch.setattr(rating, "rating_cache", rating.RatingCache(ttl, 1000))
+    users = [f"user{i}" for i in range(4)]
+    rounds = 30
+    errors = []
+    done = threading.Event()
+
+    def writer(username):
+        # Пользователя меняет только этот поток: каждое чтение обязано видеть ровно свои изменения
+        try:
+            with rating.app.app_context():
+                for i in range(rounds):
+                    stars = rating.defer_deltas({username: 1})[username]
+                    if stars != i + 2:
+                        errors.append((username, i + 2, stars))
+        except Exception as e:
+            errors.append(e)
+
+    def flusher():
+        while not done.is_set():
+            rating.flush_ratings()
+            time.sleep(0.001)
+
+    flush_thread = threading.Thread(target=flusher)
+    flush_thread.start()
+    threads = [threading.Thread(target=writer, args=(username,)) for username in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    flush_thread.join()
+    rating.flush_ratings()
+
+    assert errors == []
+    assert rating.rating_cache.stats()["pending"] == 0
+    for username in users:
+        assert stored_stars(rating, username) == rounds + 1
+
+
+def test_flush_failure_keeps_deltas(rating, monkeypatch):
+    monkeypatch.setattr(rating, "rating_cache", rating.RatingCache(60, 1000))
+    apply_deltas = rating.apply_deltas
+
+    def broken(deltas):
+        raise RuntimeError("connection lost")
+
+    rating.rating_cache.add({"alice": 3})
+    monkeypatch.setattr(rating, "apply_deltas", broken)
+    with pytest.raises(RuntimeError):
+        rating.flush_ratings()
+
+    # Изменения вернулись в pending, чтение не ждёт оборвавшийся сброс
+    assert rating.rating_cache.inflight == {}
+    assert rating.rating_cache.stats()["flushErrors"] == 1
+    with rating.app.app_context():
+        assert rating.read_ratings(["alice"], create=False) == {"alice": 4}
+
+    monkeypatch.setattr(rating, "apply_deltas", apply_deltas)
+    assert rating.flush_ratings() == 1
+    assert stored_stars(rating, "alice") == 4
+    assert rating.rating_cache.stats()["pending"] == 0
+
+
+def test_lookup_does_not_wait_forever_for_flush(rating, monkeypatch):
+    monkeypatch.setattr(rating, "rating_cache", rating.RatingCache(60, 1000))
+    monkeypatch.setattr(rating, "RATING_FLUSH_WAIT", 0.1)
+    rating.rating_cache.add({"bob": 2})
+    # Сброс начался и не завершается - как при зависшей базе
+    assert rating.rating_cache.begin_flush() == {"bob": 2}
+
+    started = time.monotonic()
+    with rating.app.app_context():
+        assert rating.read_ratings(["bob"], create=False) == {"bob": 3}
+    assert time.monotonic() - started < 2
+    # Приблизительное значение в кэш не попадает
+    assert "bob" not in rating.rating_cache.entries
+
+    rating.rating_cache.end_flush(None)
+    assert rating.rating_cache.pending == {"bob": 2}
@@ -0,0 +1,96 @@
+from datetime import date
+
+from test_reservation_expiry import USER, create, expire
+
+
+def rented(client, username="Test Max"):
+    return client.get(f"/reservations/{username}/count").get_json()["rentedCount"]
+
+
+def set_counter(reservation, username, value):
+    with reservation.app.app_context():
+        reservation.db.session.execute(
+            reservation.update(reservation.RentedCount)
+            .where(reservation.RentedCount.username == username)
+            .values(rented=value)
+        )
+        reservation.db.session.commit()
+
+
+def test_counter_follows_create_return_and_expire(reservation):
+    client = reservation.app.test_client()
+    first = create(client, "2030-01-01")
+    second = create(client, "2021-10-11")
+    assert rented(client) == 2
+
+    resp = client.post("/reservations", headers=USER, json={
+        "bookUid": "b", "libraryUid": "l", "tillDate": "2030-01-01", "maxRented": 2
+    })
+    assert resp.status_code == 409
+    assert resp.get_json()["rentedCount"] == 2
+
+    resp = client.post(f"/reservations/{first}/return", headers=USER,
+                       json={"condition": "GOOD", "date": "2029-12-31"})
+    assert resp.status_code == 204
+    assert rented(client) == 1
+
+    with reservation.app.app_context():
+        reservation.db.session.execute(
+            reservation.update(reservation.Reservation)
+            .where(reservation.Reservation.reservation_uid == second)
+            .values(start_date=date(2021, 10, 1))
+        )
+        reservation.db.session.commit()
+    assert expire(reservation) == 1
+    assert rented(client) == 0
+
+    # Возврат просроченной брони место в лимите второй раз не освобождает
+    resp = client.post(f"/reservations/{second}/return", headers=USER,
+                       json={"condition": "GOOD", "date": "2030-01-01"})
+    assert resp.status_code == 200
+    assert rented(client) == 0
+
+
+def test_batch_counts_every_item(reservation):
+    client = reservation.app.test_client()
+    items = [{"bookUid": f"book-{i}", "libraryUid": "l", "tillDate": "2030-01-01"} for i in range(3)]
+
+    resp = client.post("/reservations/batch", headers=USER, json={"items": items, "maxRented": 2})
+    assert resp.status_code == 409
+    assert rented(client) == 0
+
+    resp = client.post("/reservations/batch", headers=USER, json={"items": items, "maxRented": 3})
+    assert resp.status_code == 200
+    assert rented(client) == 3
+
+
+def test_reconcile_fixes_counter_drift(reservation):
+    client = reservation.app.test_client()
+    create(client, "2030-01-01")
+    create(client, "2030-01-01", user={"X-User-Name": "Other"})
+    set_counter(reservation, "Test Max", 5)
+    set_counter(reservation, "Other", 0)
+
+    resp = client.post("/manage/reconcile")
+    assert resp.status_code == 200
+    assert resp.get_json() == {"countersFixed": 2}
+    assert rented(client) == 1
+    assert rented(client, "Other") == 1
+    assert client.post("/manage/reconcile").get_json() == {"countersFixed": 0}
+
+    result = reservation.app.test_cli_runner().invoke(args=["reconcile"])
+    assert result.exit_code == 0
+    assert "Rented counters fixed: 0" in result.output
+
+
+def test_sweep_runs_reconcile_when_due(reservation, monkeypatch):
+    client = reservation.app.test_client()
+    create(client, "2030-01-01")
+    set_counter(reservation, "Test Max", 3)
+    # Недоступный rating_service - outbox просто остаётся до следующего прохода
+    monkeypatch.setattr(reservation, "RATING_URL", "http://127.0.0.1:9")
+    monkeypatch.setattr(reservation, "RECONCILE_INTERVAL", 1)
+    monkeypatch.setattr(reservation, "_last_reconcile", 0)
+
+    assert reservation.sweep() == {"expired": 0, "ratingDeltas": 0, "countersFixed": 1}
+    assert rented(client) == 1
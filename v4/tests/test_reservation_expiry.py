@@ -0,0 +1,55 @@
+from datetime import date, timedelta
+
+USER = {"X-User-Name": "Test Max"}
+
+
+def create(client, till_date, user=USER):
+    resp = client.post("/reservations", headers=user, json={
+        "bookUid": "f7cdc58f-2caf-4b15-9727-f89dcc629b27", "libraryUid": "83575e12-7ce0-48ee-9931-51919ff3c9ee",
+        "tillDate": till_date, "maxRented": 5
+    })
+    assert resp.status_code == 200
+    return resp.get_json()["reservationUid"]
+
+
+def expire(reservation):
+    with reservation.app.app_context():
+        return reservation.expire_overdue()
+
+
+def status(client, reservation_uid):
+    return client.get(f"/reservations/{reservation_uid}/return", headers=USER).get_json()["status"]
+
+
+def test_past_till_date_survives_sweep_on_the_same_day(reservation):
+    # Сценарий Postman: бронь с tillDate в прошлом, затем возврат и +1 звезда
+    client = reservation.app.test_client()
+    reservation_uid = create(client, "2021-10-11")
+
+    assert expire(reservation) == 0
+    assert status(client, reservation_uid) == "RENTED"
+    resp = client.post(f"/reservations/{reservation_uid}/return", headers=USER,
+                       json={"condition": "EXCELLENT", "date": "2021-10-10"})
+    assert resp.status_code == 204
+
+
+def test_overdue_reservation_expires_with_penalty(reservation):
+    client = reservation.app.test_client()
+    reservation_uid = create(client, "2021-10-11")
+    kept_uid = create(client, (date.today() + timedelta(days=7)).isoformat())
+    with reservation.app.app_context():
+        reservation.db.session.execute(
+            reservation.update(reservation.Reservation)
+            .where(reservation.Reservation.reservation_uid == reservation_uid)
+            .values(start_date=date(2021, 10, 1))
+        )
+        reservation.db.session.commit()
+
+    assert expire(reservation) == 1
+    assert status(client, reservation_uid) == "EXPIRED"
+    assert status(client, kept_uid) == "RENTED"
+    with reservation.app.app_context():
+        deltas = reservation.db.session.execute(
+            reservation.select(reservation.RatingDelta.username, reservation.RatingDelta.delta)
+        ).all()
+    assert [tuple(row) for row in deltas] == [("Test Max", -reservation.EXPIRY_PENALTY)]